@@ -0,0 +1,126 @@
+# bench/bench_html.py
+#
+# Checks replace_html_tags against BeautifulSoup on a corpus of description
+# snippets, then times both on OLX-sized descriptions.
+#
+#   python bench/bench_html.py [--repeat N]
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+from render import replace_html_tags, escape_text, DESCRIPTION_LENGTH
+
+CORPUS = [
+    '',
+    'Plain text without markup',
+    'a<br/>b',
+    'a<br/><br />b',
+    '<p>x</p>\n<p>y</p>',
+    'a <b>c</b> d',
+    '<p><strong>Mieszkanie 2-pokojowe</strong>&nbsp;do wynajęcia</p>',
+    '<ul><li>Kuchnia</li><li>Łazienka &ndash; prysznic</li></ul>',
+    'Czynsz: 600 z&#322; + media &amp; internet',
+    'x &amp y',
+    '&lt;p&gt; is escaped markup',
+    '&#x41;&#65;&#0;',
+    'a<!-- comment -->b',
+    'a<!-- x -- > y',
+    'ł<!--<img src=x>&amp;b',
+    '<!--><p>x</p>',
+    'a<!--b',
+    'a<!--x-->y<!--z',
+    '<!DOCTYPE html><html><body>x</body></html>',
+    '<![CDATA[raw]]>y',
+    'x<?php echo 1; ?>y',
+    '<script>var a = "<p>";</script>visible',
+    '<SCRIPT type="text/javascript">a</script >b',
+    '<style>p { color: red }</style>text',
+    'a<script>x<p>y&amp;',
+    'a<style>p{}<b>c</b>',
+    'a<style>x</style',
+    '<script>\n',
+    'a<script>x</ script>y',
+    'a<script/>b</script>c',
+    'a<script x="1',
+    '<![CDATA[]]>x',
+    'a<![CDATA[x>y',
+    'b</>c',
+    'a</p x="y>z">b',
+    '<p>x</p>\n\n<p>y</p>',
+    '<p class="a>b">quoted attribute</p>',
+    "<a href='x>y' title=\"z\">link</a> after",
+    'a < b and c > d',
+    'a<b',
+    'a <3 b',
+    'a< /b>c',
+    '<unclosed',
+    'x\r\ny',
+    '<p>' + 'Długi opis mieszkania. ' * 30 + '</p>',
+    '<p>*Bold* _italic_ `code` [link]</p>',
+]
+
+SAMPLE = (
+    '<p><strong>Do wynajęcia</strong> przestronne mieszkanie 2-pokojowe w Krakowie, '
+    'ul. Przykładowa 12.</p><p>Mieszkanie składa się z:</p><ul><li>salonu z aneksem kuchennym,</li>'
+    '<li>sypialni,</li><li>łazienki z prysznicem &amp; pralką.</li></ul><br />'
+    '<p>Czynsz 2&nbsp;500 z&#322; + opłaty (ok. 600&nbsp;zł).</p>'
+) * 8
+
+
+def bs4_text(text):
+    return BeautifulSoup(text, "html.parser").get_text(separator=' ')
+
+
+def description(text, strip):
+    description = escape_text(strip(text))
+    if len(description) > DESCRIPTION_LENGTH:
+        description = description[:DESCRIPTION_LENGTH] + '...'
+    return description
+
+
+def check_corpus():
+    failures = 0
+    for text in CORPUS:
+        expected = bs4_text(text)
+        actual = replace_html_tags(text)
+        if actual != expected:
+            failures += 1
+            print(f"MISMATCH {text!r}: {actual!r} != {expected!r}")
+        # The truncated path must give the same description as stripping everything
+        truncated = description(text, lambda t: replace_html_tags(t, limit=DESCRIPTION_LENGTH))
+        if truncated != description(text, bs4_text):
+            failures += 1
+            print(f"TRUNCATION MISMATCH {text!r}")
+    print(f"corpus: {len(CORPUS) - failures}/{len(CORPUS)} cases match BeautifulSoup")
+    return failures == 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    ok = check_corpus()
+
+    timings = {
+        'bs4 get_text': lambda: bs4_text(SAMPLE),
+        'replace_html_tags': lambda: replace_html_tags(SAMPLE),
+        f'replace_html_tags(limit={DESCRIPTION_LENGTH})': lambda: replace_html_tags(SAMPLE, limit=DESCRIPTION_LENGTH),
+    }
+    print(f"sample: {len(SAMPLE)} characters, {args.repeat} runs")
+    baseline = None
+    for name, func in timings.items():
+        seconds = min(timeit.repeat(func, number=args.repeat, repeat=3)) / args.repeat
+        baseline = baseline or seconds
+        print(f"{name:32} {seconds * 1e6:9.1f} us  {baseline / seconds:6.1f}x")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
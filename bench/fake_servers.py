@@ -0,0 +1,226 @@
+# bench/fake_servers.py
+#
+# Local stand-ins for the OLX offers API and the Telegram Bot API, used by
+# the benchmark harness. Both run on stdlib HTTP servers in background threads.
+
+import datetime
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DISTRICTS = {
+    '261': 'Dębniki', '281': 'Bieżanów-Prokocim', '285': 'Bieńczyce', '253': 'Bronowice',
+    '283': 'Czyżyny', '279': 'Grzegórzki', '255': 'Krowodrza', '259': 'Łagiewniki-Borek Fałęcki',
+    '289': 'Mistrzejowice', '287': 'Nowa Huta', '263': 'Podgórze', '277': 'Podgórze Duchackie',
+    '275': 'Prądnik Biały', '267': 'Prądnik Czerwony', '273': 'Stare Miasto', '269': 'Swoszowice',
+    '291': 'Wzgórza Krzesławickie', '257': 'Zwierzyniec',
+}
+
+DESCRIPTION = (
+    '<p><strong>Do wynajęcia</strong> mieszkanie w dobrej lokalizacji.</p>'
+    '<ul><li>umeblowane,</li><li>balkon &amp; piwnica,</li><li>blisko komunikacji.</li></ul>'
+    '<p>Czynsz 2&nbsp;500 z&#322; + opłaty.</p>'
+) * 3
+
+
+class Server:
+    def __init__(self, handler):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.app = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class OlxHandler(JSONHandler):
+    def do_GET(self):
+        app = self.server.app
+        url = urlparse(self.path)
+        if url.path.rstrip('/').endswith('/districts'):
+            # Every city gets the Kraków districts
+            self.send_json(200, {'data': [{'id': int(district_id), 'name': name} for district_id, name in DISTRICTS.items()]})
+            return
+        if not url.path.rstrip('/').endswith('/offers'):
+            self.send_json(404, {'error': 'not found'})
+            return
+        time.sleep(app.latency)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        self.send_json(200, {'data': app.page(params)})
+
+
+class FakeOlx(Server):
+    """
+    Serves /api/v1/offers/ sorted newest first, honoring offset/limit and the
+    district and price filters, and a district list for any city.
+    add_listings() simulates new arrivals.
+    """
+
+    def __init__(self, latency=0.05, seed=0):
+        super().__init__(OlxHandler)
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.items = []  # newest first
+        self.next_id = 900000000
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def add_listings(self, count):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        new_items = []
+        for i in range(count):
+            self.next_id += 1
+            district_id = self.random.choice(list(DISTRICTS))
+            price = self.random.randrange(1500, 6000, 50)
+            rent = self.random.choice([None, 300, 450, 600, 800])
+            params = [
+                {'key': 'price', 'value': {'label': f"{price:,} zł".replace(',', ' '), 'value': price}},
+                {'key': 'm', 'value': {'label': f"{self.random.randint(20, 90)} m²"}},
+                {'key': 'rooms', 'value': {'label': '2 pokoje', 'key': 'two'}},
+            ]
+            if rent:
+                params.append({'key': 'rent', 'value': {'label': f"{rent} zł"}})
+            new_items.append({
+                'id': self.next_id,
+                'title': f"Mieszkanie {self.next_id} - {DISTRICTS[district_id]}",
+                'url': f"https://www.olx.pl/d/oferta/mieszkanie-{self.next_id}.html",
+                'pushup_time': (now - datetime.timedelta(milliseconds=i)).isoformat(),
+                'business': self.random.random() < 0.4,
+                'description': DESCRIPTION,
+                'params': params,
+                'location': {
+                    'region': {'id': 4, 'name': 'Małopolskie', 'normalized_name': 'malopolskie'},
+                    'district': {'id': int(district_id), 'name': DISTRICTS[district_id]},
+                },
+            })
+        with self.lock:
+            self.items[:0] = new_items
+
+    def page(self, params):
+        with self.lock:
+            self.requests += 1
+            items = self.items
+        if params.get('district_id'):
+            items = [i for i in items if str(i['location']['district']['id']) == params['district_id']]
+        low = params.get('filter_float_price:from')
+        high = params.get('filter_float_price:to')
+        if low or high:
+            items = [i for i in items if (not low or i['params'][0]['value']['value'] >= float(low))
+                     and (not high or i['params'][0]['value']['value'] <= float(high))]
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 50))
+        return items[offset:offset + limit]
+
+
+class BotApiHandler(JSONHandler):
+    def do_POST(self):
+        self.handle_method()
+
+    def do_GET(self):
+        self.handle_method()
+
+    def handle_method(self):
+        app = self.server.app
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+        method = urlparse(self.path).path.rsplit('/', 1)[-1]
+        if self.headers.get('Content-Type', '').startswith('application/json') and raw:
+            data = json.loads(raw)
+        else:
+            data = {key: values[0] for key, values in parse_qs(raw.decode()).items()}
+
+        time.sleep(app.latency)
+        if method == 'getMe':
+            self.send_json(200, {'ok': True, 'result': {
+                'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}})
+        elif method == 'sendMessage':
+            retry_after = app.admit(int(data.get('chat_id')))
+            if retry_after:
+                self.send_json(429, {'ok': False, 'error_code': 429,
+                                     'description': f"Too Many Requests: retry after {retry_after}",
+                                     'parameters': {'retry_after': retry_after}})
+                return
+            app.messages.append((int(data.get('chat_id')), data.get('text', '')))
+            self.send_json(200, {'ok': True, 'result': {
+                'message_id': app.sent, 'date': int(time.time()), 'text': data.get('text', ''),
+                'chat': {'id': int(data.get('chat_id')), 'type': 'private'}}})
+        elif method == 'setWebhook':
+            app.webhook = data
+            self.send_json(200, {'ok': True, 'result': True})
+        elif method == 'deleteWebhook':
+            app.webhook = None
+            self.send_json(200, {'ok': True, 'result': True})
+        elif method == 'getWebhookInfo':
+            self.send_json(200, {'ok': True, 'result': {
+                'url': (app.webhook or {}).get('url', ''), 'has_custom_certificate': False, 'pending_update_count': 0}})
+        else:
+            self.send_json(200, {'ok': True, 'result': True})
+
+
+class FakeBotApi(Server):
+    """
+    Accepts sendMessage and enforces a global and a per-chat messages-per-second
+    limit, answering 429 with retry_after like Telegram does. setWebhook and
+    deleteWebhook are recorded in webhook.
+    """
+
+    def __init__(self, latency=0.03, global_rate=30, chat_rate=1, chat_burst=3):
+        super().__init__(BotApiHandler)
+        self.latency = latency
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.lock = threading.Lock()
+        self.recent = []  # Send times within the last second
+        self.chats = defaultdict(lambda: (chat_burst, time.monotonic()))  # chat_id -> (tokens, updated)
+        self.sent = 0
+        self.rejected = 0
+        self.messages = []  # (chat_id, text) of every accepted sendMessage
+        self.webhook = None  # Parameters of the last setWebhook
+
+    def admit(self, chat_id):
+        now = time.monotonic()
+        with self.lock:
+            self.recent = [t for t in self.recent if now - t < 1]
+            tokens, updated = self.chats[chat_id]
+            tokens = min(self.chat_burst, tokens + (now - updated) * self.chat_rate)
+            if len(self.recent) >= self.global_rate or tokens < 1:
+                self.chats[chat_id] = (tokens, now)
+                self.rejected += 1
+                return 1
+            self.chats[chat_id] = (tokens - 1, now)
+            self.recent.append(now)
+            self.sent += 1
+            return 0
@@ -0,0 +1,255 @@
+# bench/run_bench.py
+#
+# Offline end-to-end benchmark: runs the real polling tick against a fake OLX
+# API and a fake Telegram Bot API, and reports per-stage timings.
+#
+#   python bench/run_bench.py --users 200 --ticks 5 --arrivals 40
+#   python bench/run_bench.py --compare bench/results/<earlier run>.json
+#
+# Results are written to bench/results/<time>-<commit>.json.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'bench', 'results')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import DISTRICTS, FakeBotApi, FakeOlx
+
+STAGES = ('fetch', 'save', 'match', 'dedup', 'render', 'tick', 'drain')
+
+
+class StageTimer:
+    def __init__(self):
+        self.totals = defaultdict(float)
+
+    def add(self, stage, seconds):
+        self.totals[stage] += seconds
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+    def wrap_async(self, stage, func):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+        return timed
+
+    def wrap_async_gen(self, stage, func):
+        # Only time spent waiting for the next item counts, not the caller's work
+        def timed(*args, **kwargs):
+            gen = func(*args, **kwargs)
+
+            async def iterate():
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        item = await gen.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    finally:
+                        self.add(stage, time.perf_counter() - start)
+                    yield item
+            return iterate()
+        return timed
+
+    def take(self):
+        totals, self.totals = dict(self.totals), defaultdict(float)
+        return totals
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def seed_users(db, count, rng):
+    districts = list(DISTRICTS)
+    for user_id in range(1, count + 1):
+        min_price = rng.choice([None, 1500, 2000, 2500, 3000])
+        max_price = rng.choice([None, 3000, 3500, 4000, 5000])
+        if min_price and max_price and min_price > max_price:
+            min_price, max_price = max_price, min_price
+        db.set_user_filters(
+            user_id,
+            min_price=min_price,
+            max_price=max_price,
+            districts=rng.sample(districts, rng.choice([0, 1, 2, 3])),
+            from_owner=rng.random() < 0.2,
+            use_total_price=rng.random() < 0.2,
+        )
+        db.set_user_active(user_id, True)
+
+
+def summarize(ticks):
+    summary = {}
+    for stage in STAGES + ('messages',):
+        values = [tick.get(stage, 0) for tick in ticks]
+        summary[stage] = {
+            'mean': statistics.fmean(values),
+            'p50': statistics.median(values),
+            'max': max(values),
+        }
+    total_messages = sum(tick['messages'] for tick in ticks)
+    total_time = sum(tick['tick'] + tick['drain'] for tick in ticks)
+    summary['throughput_msgs_per_s'] = total_messages / total_time if total_time else 0
+    return summary
+
+
+def print_summary(summary, baseline=None):
+    print(f"{'stage':10} {'mean ms':>10} {'p50 ms':>10} {'max ms':>10}" + ("  vs baseline" if baseline else ''))
+    for stage in STAGES:
+        row = summary[stage]
+        line = f"{stage:10} {row['mean'] * 1e3:10.1f} {row['p50'] * 1e3:10.1f} {row['max'] * 1e3:10.1f}"
+        if baseline and baseline.get(stage, {}).get('mean'):
+            line += f"  {row['mean'] / baseline[stage]['mean'] - 1:+8.1%}"
+        print(line)
+    print(f"messages per tick: {summary['messages']['mean']:.1f}, "
+          f"throughput: {summary['throughput_msgs_per_s']:.1f} msg/s")
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='olx-bench-')
+    os.chdir(workdir)  # bot.py creates listings.db in the working directory on import
+
+    olx = FakeOlx(latency=args.olx_latency, seed=args.seed).start()
+    bot_api = FakeBotApi(latency=args.telegram_latency, global_rate=args.telegram_rate).start()
+
+    import olx_api
+    import db
+    import bot
+    import repository
+    logging.getLogger().setLevel(args.log_level)
+    from delivery import DeliveryDispatcher
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+
+    olx_api.OLX_API_URL = f"{olx.url}/api/v1/offers/"
+
+    telegram_bot = Bot('123:bench', base_url=f"{bot_api.url}/bot",
+                       request=HTTPXRequest(connection_pool_size=args.workers * 2))
+    await telegram_bot.initialize()
+    application = types.SimpleNamespace(bot=telegram_bot, bot_data={})
+    bot.dispatcher = DeliveryDispatcher(
+        lambda user_id, listing: bot.send_listing(application, user_id, listing),
+        repository.mark_listings_as_sent,
+        workers=args.workers,
+        global_rate=args.global_rate,
+    )
+    bot.dispatcher.start()
+
+    timer = StageTimer()
+    bot.iter_listing_pages = timer.wrap_async_gen('fetch', bot.iter_listing_pages)
+    bot.save_listings_to_db = timer.wrap_async('save', bot.save_listings_to_db)
+    bot.subscription_index.match = timer.wrap('match', bot.subscription_index.match)
+    repository.get_sent_listing_ids_for_users = timer.wrap_async('dedup', repository.get_sent_listing_ids_for_users)
+    bot.render_listing = timer.wrap('render', bot.render_listing)
+
+    ticks = []
+    try:
+        # Ingest the backlog before any users exist, so measured ticks only see new arrivals
+        olx.add_listings(args.backlog)
+        await bot.global_check_new_listings(application)
+        timer.take()
+
+        seed_users(db, args.users, random.Random(args.seed))
+        bot.subscription_index.load(db.get_active_user_filters())
+        repository.add_user_listener(bot.refresh_subscription)
+
+        for tick_number in range(1, args.ticks + 1):
+            olx.add_listings(args.arrivals)
+            sent_before = bot_api.sent
+            start = time.perf_counter()
+            await bot.global_check_new_listings(application)
+            tick_time = time.perf_counter() - start
+            while bot.dispatcher.queue_depth():
+                await asyncio.sleep(0.01)
+            drain_time = time.perf_counter() - start - tick_time
+            stages = timer.take()
+            stages.update(tick=tick_time, drain=drain_time, messages=bot_api.sent - sent_before)
+            ticks.append(stages)
+            print(f"tick {tick_number}: " + ', '.join(f"{k}={v * 1e3:.1f}ms" for k, v in stages.items()
+                                                    if k != 'messages') + f", messages={stages['messages']}")
+    finally:
+        await bot.dispatcher.stop()
+        await telegram_bot.shutdown()
+        await olx_api.close_http_client()
+        await repository.close()
+        olx.stop()
+        bot_api.stop()
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': vars(args),
+        'olx_requests': olx.requests,
+        'telegram_429s': bot_api.rejected,
+        'summary': summarize(ticks),
+        'ticks': ticks,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--ticks', type=int, default=5)
+    parser.add_argument('--backlog', type=int, default=250, help="listings present before the first tick")
+    parser.add_argument('--arrivals', type=int, default=10, help="new listings per tick")
+    parser.add_argument('--olx-latency', type=float, default=0.05)
+    parser.add_argument('--telegram-latency', type=float, default=0.03)
+    parser.add_argument('--telegram-rate', type=int, default=30, help="fake Bot API global limit, msg/s")
+    parser.add_argument('--global-rate', type=float, default=25, help="dispatcher global limit, msg/s")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    parser.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+    compare = os.path.abspath(args.compare) if args.compare else None
+    no_save = args.no_save
+    del args.compare, args.no_save
+
+    result = asyncio.run(run(args))
+    print(f"OLX requests: {result['olx_requests']}, Telegram 429s: {result['telegram_429s']}")
+
+    baseline = None
+    if compare:
+        with open(compare) as f:
+            baseline = json.load(f)['summary']
+    print_summary(result['summary'], baseline)
+
+    if not no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{result['timestamp'].replace(':', '')}-{result['commit']}.json")
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"results saved to {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# bench/webhook_check.py
+#
+# Runs the bot in webhook mode against the fake Telegram Bot API, posts fake
+# updates to its webhook the way Telegram would, and reports the command
+# round trip: from posting an update to the bot's reply reaching the API.
+#
+#   python bench/webhook_check.py --updates 50
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_servers import FakeBotApi, FakeOlx
+
+SECRET = 'webhook-check-secret'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def command_update(update_id, chat_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()), 'text': text,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Check'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}],
+        },
+    }
+
+
+async def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Timed out waiting for the bot")
+        await asyncio.sleep(0.005)
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix='olx-webhook-')
+    os.chdir(workdir)  # bot.py creates listings.db in the working directory on import
+
+    olx = FakeOlx(latency=0).start()
+    bot_api = FakeBotApi(latency=args.telegram_latency, global_rate=1000, chat_burst=1000).start()
+    port = free_port()
+    webhook_url = f"http://127.0.0.1:{port}/telegram"
+    # bot.py reads its settings on import
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': '123:check',
+        'TELEGRAM_API_BASE_URL': f"{bot_api.url}/bot",
+        'WEBHOOK_URL': webhook_url,
+        'WEBHOOK_LISTEN': '127.0.0.1',
+        'WEBHOOK_PORT': str(port),
+        'WEBHOOK_SECRET': SECRET,
+        'UPDATE_CONCURRENCY': str(args.concurrency),
+    })
+
+    import httpx
+    import olx_api
+    import bot
+
+    # post_init loads the district catalogs
+    olx_api.OLX_DISTRICTS_URL = f"{olx.url}/api/v1/cities/{{city_id}}/districts/"
+
+    stop = asyncio.Event()
+    task = asyncio.create_task(bot.run_webhook(bot.build_application(), stop))
+    try:
+        await wait_for(lambda: bot_api.webhook is not None or task.done())
+        if task.done():
+            task.result()
+        print(f"setWebhook: url={bot_api.webhook.get('url')} max_connections={bot_api.webhook.get('max_connections')}")
+
+        async with httpx.AsyncClient() as client:
+            update = json.dumps(command_update(1, 1, '/help'))
+            response = await client.post(webhook_url, content=update, headers={'Content-Type': 'application/json'})
+            print(f"without secret token: {response.status_code}")
+            response = await client.post(webhook_url, content=update, headers={
+                'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+            print(f"wrong secret token: {response.status_code}")
+
+            async def round_trip(update_id):
+                chat_id = 1000 + update_id
+                started = time.perf_counter()
+                response = await client.post(webhook_url, content=json.dumps(command_update(update_id, chat_id, '/help')),
+                                             headers={'Content-Type': 'application/json',
+                                                      'X-Telegram-Bot-Api-Secret-Token': SECRET})
+                response.raise_for_status()
+                await wait_for(lambda: any(chat == chat_id for chat, _ in bot_api.messages))
+                return time.perf_counter() - started
+
+            times = await asyncio.gather(*(round_trip(update_id) for update_id in range(2, args.updates + 2)))
+        print(f"{len(times)} updates answered, round trip mean {statistics.fmean(times) * 1e3:.1f} ms, "
+              f"max {max(times) * 1e3:.1f} ms")
+    finally:
+        stop.set()
+        await task
+        bot_api.stop()
+        olx.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--updates', type=int, default=20, help='commands posted at once')
+    parser.add_argument('--concurrency', type=int, default=8, help='UPDATE_CONCURRENCY for the bot')
+    parser.add_argument('--telegram-latency', type=float, default=0.03, help='fake Bot API latency in seconds')
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
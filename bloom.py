@@ -0,0 +1,77 @@
+# bloom.py
+
+import hashlib
+import math
+import threading
+import time
+
+
+class BloomFilter:
+    def __init__(self, capacity, fp_rate):
+        self.size = max(8, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+
+class RotatingBloomFilter:
+    """
+    Bloom filter over a sliding time window.
+
+    Keys go into the newest of several generations, each covering
+    window / (generations - 1) seconds. When the newest generation is that
+    old a fresh one is started and the oldest is dropped, so every key added
+    within the window is still present. There are no false negatives inside
+    the window; a hit only means "maybe" and must be confirmed elsewhere.
+    """
+
+    def __init__(self, capacity, fp_rate, window, generations=3):
+        self.capacity = capacity
+        self.generations = generations
+        self.span = window / (generations - 1)
+        # Each generation is sized for the whole window, since a rebuild from the
+        # database puts all recent keys in one; a lookup can hit in any of them
+        self.generation_capacity = capacity
+        self.generation_fp_rate = fp_rate / generations
+        self.filters = [self._new_filter()]
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _new_filter(self):
+        return BloomFilter(self.generation_capacity, self.generation_fp_rate)
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self.started >= self.span:
+            self.filters.insert(0, self._new_filter())
+            del self.filters[self.generations:]
+            self.started = now
+
+    def add(self, key):
+        with self.lock:
+            self._rotate()
+            self.filters[0].add(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            self._rotate()
+            return any(key in f for f in self.filters)
+
+    @property
+    def memory_bytes(self):
+        return sum(len(f.bits) for f in self.filters)
@@ -3,28 +3,69 @@
 import asyncio
 import logging
 import os
+import secrets
+import signal
+import socket
 from dotenv import load_dotenv
 from telegram import Update
+from urllib.parse import urlparse
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, ContextTypes, ConversationHandler, MessageHandler, CallbackQueryHandler, filters
 )
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from db import (
-    init_db, get_user_filters, set_user_filters, reset_user_filters,
-    has_user_received_listing, mark_listing_as_sent, set_user_active,
-    get_active_users, save_listings_to_db, get_listings_from_db,
-    clean_old_listings, get_latest_listing_time
+from telegram.error import RetryAfter
+from db import init_db, acquire_lease as acquire_lease_now
+from repository import (
+    get_user_filters, set_user_filters, reset_user_filters,
+    mark_listings_as_sent, set_user_active,
+    get_active_users, save_listings_to_db, get_backfill_listings,
+    run_retention, get_latest_listing_time, get_active_user_filters, add_user_listener,
+    get_watermark, set_user_feed, get_districts, save_districts, add_user_district, remove_user_district,
+    acquire_lease, release_lease
 )
-from olx_api import fetch_listings, fetch_districts
-from telegram.helpers import escape_markdown
+import repository
+from olx_api import iter_listing_pages, query_key, fetch_districts, close_http_client, FetchError
+from feeds import FEEDS, get_feed
+from subscriptions import SubscriptionIndex
+from delivery import DeliveryDispatcher, GLOBAL_RATE, BACKFILL_RATE
+from render import render_listing
+from scheduler import AdaptivePoller
+from planner import plan_queries
+from worker import ShardWorker, parse_shard, route_listings, replay_recent_listings
+import metrics
+import webhook
 import difflib
-from bs4 import BeautifulSoup
 from unidecode import unidecode
 import datetime
+import time
 
 load_dotenv()
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-last_listing_time = None
+METRICS_PORT = os.getenv('METRICS_PORT')  # Serve Prometheus metrics when set
+# 'all' runs everything in one process. To scale out, run one 'fetcher' (OLX
+# polling, Telegram commands, /search) and 'worker' processes with
+# BOT_SHARD=0/N ... N-1/N that deliver new listings to their share of users.
+BOT_ROLE = os.getenv('BOT_ROLE', 'all')
+BOT_SHARD = os.getenv('BOT_SHARD', '0/1')
+FETCHER_LEASE = 'fetcher'
+LEASE_TTL = 30  # Seconds a fetcher stays active without renewing its lease
+LEASE_RENEW_INTERVAL = LEASE_TTL / 3
+LEASE_HOLDER = f'{socket.gethostname()}:{os.getpid()}'
+# Point at a local Bot API server or a fake one, e.g. http://127.0.0.1:8081/bot
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL')
+# Receive updates by webhook at this public https URL instead of polling getUpdates
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '8'))  # Users whose updates are handled at once in webhook mode
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))  # Telegram's parallel webhook requests
+watermarks = {}  # OLX query key -> newest pushup_time processed, mirrored in fetch_state
+subscription_index = SubscriptionIndex()
+dispatcher = None
+poller = AdaptivePoller()
+metrics_server = None
+lease_expires_at = 0  # When this fetcher's lease runs out unless renewed
 
 # Initialize the database before any database access
 init_db()
@@ -38,24 +79,10 @@ logger = logging.getLogger(__name__)
 SET_MIN_PRICE, SET_MAX_PRICE, ADD_LOCATION, REMOVE_LOCATION = range(4)
 
 
-def escape_text(text):
-    """
-    Escape text for Telegram's Markdown V1 to prevent formatting issues.
-    """
-    if text is None:
-        return ''
-    return escape_markdown(str(text), version=1)
-
-
-def replace_html_tags(text):
-    soup = BeautifulSoup(text, "html.parser")
-    return soup.get_text(separator=' ')
-
-
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if get_user_filters(user_id) is None:
-        set_user_filters(user_id, min_price=None, max_price=None, districts=[])
+        await set_user_filters(user_id, min_price=None, max_price=None, districts=[])
 
     await update.message.reply_text(
         "Welcome to the OLX Apartment Bot! Use the /help command to see available options, or simply use /search to start."
@@ -70,6 +97,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/search - Start searching for new listings.\n"
         "/stop - Stop searching for new listings.\n"
         "/setprice - Set the price range.\n"
+        "/setcity - Choose the city and category to search.\n"
         "/listdistricts - Display available districts.\n"
         "/setfromowner - Toggle 'From Owner' setting.\n"
         "/usetotalprice - Toggle using total price (price + czynsz).\n"
@@ -113,7 +141,7 @@ async def set_max_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if filters is None:
         filters = {'min_price': None, 'max_price': None, 'districts': []}
 
-    set_user_filters(user_id, min_price=min_price, max_price=max_price, districts=filters.get('districts', []))
+    await set_user_filters(user_id, min_price=min_price, max_price=max_price, districts=filters.get('districts', []))
     await update.message.reply_text(f"Price range successfully set to {min_price} - {max_price} zł.")
     return ConversationHandler.END
 
@@ -130,7 +158,7 @@ async def remove_location_command(update: Update, context: ContextTypes.DEFAULT_
 
 async def reset_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    reset_user_filters(user_id)
+    await reset_user_filters(user_id)
     await update.message.reply_text("All filters have been reset.")
 
 
@@ -143,10 +171,11 @@ async def get_filters(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     message = "Current filters:\n"
+    message += f"City: {get_feed(filters['feed_id'])['name']}\n"
     message += f"Price range: {filters.get('min_price', 'Not set')} - {filters.get('max_price', 'Not set')} zł\n"
 
     if filters['districts']:
-        district_name_to_id = context.bot_data.get('district_name_to_id', {})
+        district_name_to_id = get_feed_districts(context, filters['feed_id'])
         id_to_district_name = {v: k for k, v in district_name_to_id.items()}
         districts = [id_to_district_name.get(id, 'Unknown').title() for id in filters['districts']]
         message += "Locations: " + ', '.join(districts) + "\n"
@@ -169,7 +198,7 @@ async def set_from_owner(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     current_setting = filters.get('from_owner', False)
     new_setting = not current_setting
-    set_user_filters(user_id, from_owner=new_setting)
+    await set_user_filters(user_id, from_owner=new_setting)
 
     status = "now only" if new_setting else "no longer"
     await update.message.reply_text(f"You will {status} receive listings from owners.")
@@ -184,44 +213,15 @@ async def use_total_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     current_setting = filters.get('use_total_price', False)
     new_setting = not current_setting
-    set_user_filters(user_id, use_total_price=new_setting)
+    await set_user_filters(user_id, use_total_price=new_setting)
 
     status = "now" if new_setting else "no longer"
     await update.message.reply_text(f"You will {status} use the total price (price + czynsz) for filtering.")
 
 
+@metrics.SEND_SECONDS.timed
 async def send_listing(context: ContextTypes.DEFAULT_TYPE, user_id, listing):
-    description = escape_text(replace_html_tags(listing.get('description', '')))
-
-    if len(description) > 200:
-        description = description[:200] + '...'
-
-    rent_additional = escape_text(listing.get('rent_additional', 'No czynsz') or 'No czynsz')
-    district = escape_text(listing.get('district_name', 'District not provided') or 'District not provided')
-    area = escape_text(listing.get('area', 'N/A') or 'N/A')
-    rooms = escape_text(listing.get('rooms', 'N/A') or 'N/A')
-    is_owner = 'Yes' if not listing['is_business'] else 'No'
-    is_owner = escape_text(is_owner)
-
-    # Escape constants that contain special characters
-    title_const = "*Title:*"
-    price_const = "*Price:*"
-    district_const = "*District:*"
-    area_const = "*Area:*"
-    rooms_const = "*Rooms:*"
-    czynsz_const = "*Czynsz (additional):*"
-    from_owner_const = "From owner:"
-    view_listing_const = "View Listing"
-
-    message = (
-        f"{title_const} {escape_text(listing['title'])}\n"
-        f"💰 {price_const} {escape_text(listing['price'])} - {district_const} {district}\n"
-        f"🧭 {area_const} {area}, {rooms_const} {rooms}\n"
-        f"🐙 {czynsz_const} {rent_additional}\n"
-        f"📝 {description}\n"
-        f"🥸 {from_owner_const} {is_owner}\n"
-        f"🔗 [{escape_text(view_listing_const)}]({escape_text(listing['url'])})"
-    )
+    message = listing.get('rendered_text') or render_listing(listing)
 
     try:
         await context.bot.send_message(
@@ -230,6 +230,11 @@ async def send_listing(context: ContextTypes.DEFAULT_TYPE, user_id, listing):
             parse_mode='Markdown',
             disable_web_page_preview=False
         )
+        metrics.MESSAGES_SENT.inc()
+        if listing.get('listing_ts'):
+            metrics.DELIVERY_LAG_SECONDS.observe(time.time() - listing['listing_ts'])
+    except RetryAfter:
+        raise  # Let the dispatcher back off and retry
     except Exception as e:
         logger.error(f"Error sending message to user {user_id}: {e}")
         await context.bot.send_message(
@@ -238,94 +243,116 @@ async def send_listing(context: ContextTypes.DEFAULT_TYPE, user_id, listing):
         )
 
 
-def parse_price(price_str):
-    if price_str is None:
-        return None
-    price_str = price_str.replace(' ', '').replace('zł', '')
-    try:
-        return int(''.join(filter(str.isdigit, price_str)))
-    except ValueError:
-        return None
-
-def get_total_price(listing):
-    price_value = parse_price(listing.get('price', ''))
-    rent_value = parse_price(listing.get('rent_additional', '0'))
-    if price_value is None:
-        return None
-    return price_value + (rent_value or 0)
-
-def filter_listings_for_user(listings, filters):
-    filtered_listings = []
-    for listing in listings:
-        # Apply price filter
-        use_total_price = filters.get('use_total_price', False)
-        if use_total_price:
-            price_value = get_total_price(listing)
-        else:
-            price_value = parse_price(listing.get('price', ''))
+async def get_query_watermark(key):
+    if key not in watermarks:
+        # Databases written before watermarks were persisted fall back to the newest stored listing
+        watermarks[key] = await get_watermark(key) or await get_latest_listing_time()
+    return watermarks[key]
 
-        if price_value is None:
-            continue
-        min_price = filters.get('min_price')
-        max_price = filters.get('max_price')
-        if min_price is not None and price_value < min_price:
-            continue
-        if max_price is not None and price_value > max_price:
-            continue
 
-        # Apply district filter
-        district_ids = filters.get('districts')
-        if district_ids:
-            listing_district_id = listing.get('district_id')
-            if listing_district_id not in district_ids:
-                continue
+async def check_query(filters, seen):
+    """
+    Poll one planned OLX query and route its new listings. Listings another
+    query already handled this tick (ids in seen) are skipped.
+    """
+    key = query_key(filters)
+    time_filter = await get_query_watermark(key)
+    newest_time = time_filter
+    fetched_count = 0
+
+    # Stream listings newer than the watermark page by page, so matching and
+    # delivery of the first page overlap with fetching the next one
+    async for plistings, has_more in iter_listing_pages(filters, time_filter=time_filter):
+        for listing in plistings:
+            if not newest_time or listing['listing_time'] > newest_time:
+                newest_time = listing['listing_time']
+        plistings = [listing for listing in plistings if listing['id'] not in seen]
+        seen.update(listing['id'] for listing in plistings)
+
+        for listing in plistings:
+            # Render once here; every recipient and /search backfills reuse it
+            listing['rendered_text'] = render_listing(listing)
+
+        # Save fetched listings to the database. The watermark only moves with the
+        # final page, so a stream cut short by an error or restart is fetched again
+        if has_more:
+            new_ids = await save_listings_to_db(plistings)
+        elif newest_time != time_filter:
+            new_ids = await save_listings_to_db(plistings, watermark_key=key, watermark=newest_time)
+            if new_ids is not None:
+                watermarks[key] = newest_time
+        else:
+            new_ids = set()
+        if new_ids is None:
+            # The stored watermark has not moved, so the next poll fetches these again
+            raise RuntimeError(f"Could not save listings for query {key}")
+
+        # Listings already stored were routed when they were first saved
+        plistings = [listing for listing in plistings if listing['id'] in new_ids]
+        fetched_count += len(plistings)
 
-        # Apply 'from_owner' filter
-        from_owner = filters.get('from_owner', False)
-        if from_owner and listing['is_business']:
-            continue
+        # Route each listing straight to the users whose filters it matches. A
+        # fetcher leaves that to the workers, which read the listings from listing_log
+        if plistings and BOT_ROLE == 'all':
+            await route_listings(subscription_index, dispatcher, plistings)
 
-        filtered_listings.append(listing)
-    return filtered_listings
+    return fetched_count
 
 
 async def global_check_new_listings(context: ContextTypes.DEFAULT_TYPE):
-    global last_listing_time
+    if metrics.TICKS_IN_PROGRESS.value:
+        metrics.TICK_OVERLAPS.inc()
+    metrics.TICKS_IN_PROGRESS.inc()
     try:
-        active_user_ids = get_active_users()
-
-
-        # Fetch listings with the time filter to avoid duplicates
-        plistings, last_fetched_time = fetch_listings({}, time_filter=last_listing_time)
-
-        if not plistings:
-
+        # Narrower queries reach further back than one city-wide query, and
+        # each result is shared by every user it matches
+        queries = plan_queries(get_active_user_filters())
+        # Price bounds change as users edit their filters; forget queries that are no longer planned
+        planned = {query_key(filters) for filters in queries}
+        for key in set(watermarks) - planned:
+            del watermarks[key]
+        seen = set()
+        results = await asyncio.gather(*(check_query(filters, seen) for filters in queries),
+                                       return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        fetched_count = sum(result for result in results if not isinstance(result, BaseException))
+
+        metrics.LISTINGS_FETCHED.inc(fetched_count)
+        if errors:
+            logger.warning(f"{len(errors)} of {len(queries)} OLX queries failed")
+            raise errors[0]
+        if not fetched_count:
             logger.info("No new listings found.")
-            return
-
-        # Update the last_listing_time to avoid fetching duplicates in the next run
-        last_listing_time = last_fetched_time
-
-        # Save fetched listings to the database
-        save_listings_to_db(plistings)
-
-        for user_id in active_user_ids:
-            filters = get_user_filters(user_id)
-            if filters is None:
-                continue
-
-            user_listings = filter_listings_for_user(plistings, filters)
-
-            for listing in user_listings:
-                listing_id = listing['id']
-                if not has_user_received_listing(user_id, listing_id):
-                    await send_listing(context, user_id, listing)
-                    mark_listing_as_sent(user_id, listing_id)
-
-                    await asyncio.sleep(1)
+        else:
+            logger.info(f"Fetched {fetched_count} new listings from OLX across {len(queries)} queries")
+        return fetched_count
 
+    except FetchError as e:
+        logger.error(f"Error fetching listings: {e}")
+        raise
     except Exception as e:
         logger.error(f"Error in global_check_new_listings: {e}")
+        raise
+    finally:
+        metrics.TICKS_IN_PROGRESS.dec()
+
+
+async def poll_listings_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Run one poll, then schedule the next one after the poller's adaptive delay.
+    """
+    try:
+        with metrics.TICK_SECONDS.time():
+            new_count = await global_check_new_listings(context)
+    except FetchError as e:
+        metrics.FETCH_ERRORS.inc()
+        delay = poller.record_error(rate_limited=e.rate_limited, retry_after=e.retry_after)
+    except Exception:
+        delay = poller.record_error()
+    else:
+        delay = poller.record_success(new_count)
+    metrics.POLL_INTERVAL.set(delay)
+    context.job_queue.run_once(poll_listings_job, delay, name='poll_listings')
 
 async def start_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -334,7 +361,7 @@ async def start_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Please set your filters before starting the search.")
         return
 
-    set_user_active(user_id, True)
+    await set_user_active(user_id, True)
     await update.message.reply_text("Started searching for new listings.")
     await send_accumulated_listings(context, user_id)
 
@@ -345,27 +372,20 @@ async def send_accumulated_listings(context: ContextTypes.DEFAULT_TYPE, user_id:
         if filters is None:
             return
 
-        # Fetch listings from the database
-        listings = get_listings_from_db()
+        # Matching listings from the database that the user has not received yet, newest first
+        with metrics.BACKFILL_SECONDS.time():
+            listings = await get_backfill_listings(user_id, filters)
+        for listing in listings:
+            dispatcher.submit(user_id, listing)
         if not listings:
-            logger.info("No listings found in the database.")
-            return
-
-        user_listings = filter_listings_for_user(listings, filters)
-
-        for listing in user_listings:
-            listing_id = listing['id']
-            if not has_user_received_listing(user_id, listing_id):
-                await send_listing(context, user_id, listing)
-                mark_listing_as_sent(user_id, listing_id)
-                await asyncio.sleep(1)
+            logger.info(f"No stored listings to send to user {user_id}.")
     except Exception as e:
         logger.error(f"Error in send_accumulated_listings: {e}")
 
 
 async def stop_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    set_user_active(user_id, False)
+    await set_user_active(user_id, False)
     await update.message.reply_text("Stopped searching for new listings.")
 
 
@@ -373,9 +393,25 @@ async def stop_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ITEMS_PER_PAGE = 10
 
 
+def get_feed_districts(context, feed_id):
+    return context.bot_data.get('districts', {}).get(feed_id, {})
+
+
+async def set_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    keyboard = [[InlineKeyboardButton(feed['name'], callback_data=f"set_feed_{feed_id}")]
+                for feed_id, feed in FEEDS.items()]
+    keyboard.append([InlineKeyboardButton("Close", callback_data="close_menu")])
+    await update.message.reply_text("Choose the city and category to search:",
+                                    reply_markup=InlineKeyboardMarkup(keyboard))
+
+
 async def list_districts(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    district_name_to_id = context.bot_data.get('district_name_to_id', {})
+    filters = get_user_filters(user_id)
+    if filters is None:
+        await set_user_filters(user_id, min_price=None, max_price=None, districts=[])
+        filters = get_user_filters(user_id)
+    district_name_to_id = get_feed_districts(context, filters['feed_id'])
 
     if not district_name_to_id:
         await update.message.reply_text("No districts found. Please try again later.")
@@ -389,8 +425,7 @@ async def list_districts(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Get user's current districts
-    filters = get_user_filters(user_id)
-    user_districts = filters.get('districts', [])
+    user_districts = filters['district_set']
 
     # Create buttons for each district (2 per line)
     districts = list(district_name_to_id.items())
@@ -439,14 +474,27 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     user_id = query.from_user.id
     filters = get_user_filters(user_id)
-    user_districts = filters.get('districts', [])
-    district_name_to_id = context.bot_data.get('district_name_to_id', {})
 
     # Handle closing the menu
     if query.data == "close_menu":
         await query.edit_message_text("Menu closed.")
         return
 
+    # Handle choosing a feed
+    if query.data.startswith("set_feed_"):
+        feed_id = query.data[len("set_feed_"):]
+        if feed_id not in FEEDS:
+            await query.edit_message_text("This city is no longer available.")
+            return
+        if filters is None:
+            await set_user_filters(user_id, min_price=None, max_price=None, districts=[])
+        await set_user_feed(user_id, feed_id)
+        await query.edit_message_text(f"Now searching in {FEEDS[feed_id]['name']}. "
+                                      f"Your districts were reset; use /listdistricts to pick new ones.")
+        return
+
+    user_districts = filters['district_set']
+
     # Handle pagination
     if query.data.startswith("page_"):
         page = int(query.data.split("_")[1])
@@ -462,15 +510,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Toggle the district in user's filters
         if district_id in user_districts:
-            user_districts.remove(district_id)
-            action = "removed from"
+            await remove_user_district(user_id, district_id)
         else:
-            user_districts.append(district_id)
-            action = "added to"
-
-        # Update the filters
-        set_user_filters(user_id, min_price=filters['min_price'], max_price=filters['max_price'],
-                         districts=user_districts)
+            await add_user_district(user_id, district_id)
 
         # Refresh the menu
         context.args = [str(page)]
@@ -483,20 +525,150 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     if update and hasattr(update, 'message') and update.message:
         await update.message.reply_text("An error occurred. Please try again later.")
 
-async def clean_old_listings_job(context: ContextTypes.DEFAULT_TYPE):
-    clean_old_listings()
-    logger.info("Old listings cleaned from the database.")
+async def renew_lease_job(context: ContextTypes.DEFAULT_TYPE):
+    global lease_expires_at
+    renewed_at = time.time()
+    acquired = await acquire_lease(FETCHER_LEASE, LEASE_HOLDER, LEASE_TTL)
+    if acquired:
+        lease_expires_at = renewed_at + LEASE_TTL
+    elif acquired is None and time.time() + LEASE_RENEW_INTERVAL < lease_expires_at:
+        # The lease is still ours until after the next renewal, which tries again
+        logger.warning("Could not renew the fetcher lease, retrying.")
+    else:
+        # Another fetcher took over, or could before this one renews; two must never poll at once
+        logger.error("Lost the fetcher lease, stopping.")
+        # run_polling stops and shuts down cleanly on SIGTERM
+        os.kill(os.getpid(), signal.SIGTERM)
 
 
-def main():
-    district_name_to_id = fetch_districts()
+async def retention_job(context: ContextTypes.DEFAULT_TYPE):
+    # Deletes run in small batches on the maintenance thread, so polling and handlers keep going
+    _, size = await run_retention()
+    metrics.DB_SIZE_BYTES.set(size)
+    logger.info("Old rows cleaned from the database.")
+
+
+def refresh_subscription(user_id):
+    filters = get_user_filters(user_id)
+    if filters is None or not filters['is_active']:
+        subscription_index.remove_user(user_id)
+    else:
+        subscription_index.update_user(user_id, filters)
+
+
+async def load_feed_districts(feed_id, refresh=False):
+    """
+    Return a feed's district catalog, from the database unless it is missing
+    or a refresh is requested.
+    """
+    district_name_to_id = {} if refresh else await get_districts(feed_id)
     if not district_name_to_id:
-        logger.error("Failed to fetch district mapping.")
-        return
+        district_name_to_id = await fetch_districts(feed_id)
+        if district_name_to_id:
+            await save_districts(feed_id, district_name_to_id)
+        else:
+            district_name_to_id = await get_districts(feed_id)
+    return district_name_to_id
+
+
+async def refresh_districts_job(context: ContextTypes.DEFAULT_TYPE):
+    catalogs = await asyncio.gather(*(load_feed_districts(feed_id, refresh=True) for feed_id in FEEDS))
+    context.bot_data['districts'] = dict(zip(FEEDS, catalogs))
+    logger.info("District catalogs refreshed.")
+
 
-    application = ApplicationBuilder().token(TOKEN).build()
+async def post_init(application):
+    global dispatcher, metrics_server
+    if BOT_ROLE == 'all':
+        subscription_index.load(get_active_user_filters())
+        add_user_listener(refresh_subscription)
 
-    application.bot_data['district_name_to_id'] = district_name_to_id
+    catalogs = await asyncio.gather(*(load_feed_districts(feed_id) for feed_id in FEEDS))
+    application.bot_data['districts'] = dict(zip(FEEDS, catalogs))
+    for feed_id, catalog in application.bot_data['districts'].items():
+        if not catalog:
+            logger.error(f"No districts available for feed {feed_id}.")
+
+    dispatcher = DeliveryDispatcher(
+        lambda user_id, listing: send_listing(application, user_id, listing),
+        mark_listings_as_sent,
+        # A fetcher only sends /search backfills; the workers use the rest of the rate
+        global_rate=BACKFILL_RATE if BOT_ROLE == 'fetcher' else GLOBAL_RATE
+    )
+    dispatcher.start()
+    if BOT_ROLE == 'all':
+        await replay_recent_listings(subscription_index, dispatcher)
+
+    metrics.QUEUE_DEPTH.set_function(dispatcher.queue_depth)
+    metrics.ACTIVE_USERS.set_function(lambda: len(get_active_users()))
+    if METRICS_PORT:
+        metrics_server = await metrics.start_server(int(METRICS_PORT))
+
+
+async def post_shutdown(application):
+    if metrics_server is not None:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    if dispatcher is not None:
+        await dispatcher.stop()
+    if BOT_ROLE == 'fetcher':
+        await release_lease(FETCHER_LEASE, LEASE_HOLDER)
+    await close_http_client()
+    await repository.close()
+
+
+async def run_worker(shard_index, shard_count):
+    """
+    Deliver new listings to one shard of users. Workers only send; Telegram
+    updates are polled by the fetcher alone.
+    """
+    global metrics_server
+    builder = ApplicationBuilder().token(TOKEN)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    application = builder.build()
+    async with application:
+        worker = ShardWorker(shard_index, shard_count,
+                             lambda user_id, listing: send_listing(application, user_id, listing))
+        if METRICS_PORT:
+            metrics_server = await metrics.start_server(int(METRICS_PORT))
+        # Cancel the worker on SIGINT or SIGTERM, so it records its last sends before exiting
+        run = asyncio.create_task(worker.run())
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, run.cancel)
+        try:
+            await run
+        except asyncio.CancelledError:
+            logger.info(f"Worker {worker.name} stopped.")
+        finally:
+            if metrics_server is not None:
+                metrics_server.close()
+            await repository.close()
+
+
+def wait_for_fetcher_lease():
+    global lease_expires_at
+    # A standby fetcher blocks here until the active one stops renewing its lease
+    acquired_at = time.time()
+    if not acquire_lease_now(FETCHER_LEASE, LEASE_HOLDER, LEASE_TTL):
+        logger.info("Another fetcher is active, waiting for its lease to expire.")
+        while True:
+            time.sleep(LEASE_RENEW_INTERVAL)
+            acquired_at = time.time()
+            if acquire_lease_now(FETCHER_LEASE, LEASE_HOLDER, LEASE_TTL):
+                break
+    lease_expires_at = acquired_at + LEASE_TTL
+    logger.info(f"Acquired the fetcher lease as {LEASE_HOLDER}")
+
+
+def build_application():
+    builder = ApplicationBuilder().token(TOKEN).post_init(post_init).post_shutdown(post_shutdown)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    # Updates stay sequential here: ConversationHandler needs one user's updates
+    # in order, which webhook mode keeps while still running users in parallel
+    application = builder.build()
 
     # Add handlers
     application.add_handler(CommandHandler('start', start))
@@ -507,6 +679,7 @@ def main():
     application.add_handler(CommandHandler('stop', stop_search))
     application.add_handler(CommandHandler('setfromowner', set_from_owner))
     application.add_handler(CommandHandler('usetotalprice', use_total_price))
+    application.add_handler(CommandHandler('setcity', set_city))
     application.add_handler(CommandHandler('listdistricts', list_districts))
     application.add_handler(CallbackQueryHandler(button_handler))
 
@@ -526,14 +699,67 @@ def main():
 
     # Add error handler
     application.add_error_handler(error_handler)
+    return application
 
-    # Schedule the global job
 
-    application.job_queue.run_repeating(global_check_new_listings, interval=10, first=0)  # Every 5 minutes
+async def run_webhook(application, stop=None):
+    """
+    Take updates from Telegram's webhook instead of polling getUpdates, until
+    SIGINT or SIGTERM, or until the stop event is set.
+    """
+    stop = stop or asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
 
-    # Schedule the cleaning job to run every day at midnight
-    application.job_queue.run_daily(clean_old_listings_job, time=datetime.time(hour=0, minute=0, second=0))
-    application.run_polling()
+    # The same lifecycle run_polling goes through
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        processor = webhook.UserOrderedProcessor(application, UPDATE_CONCURRENCY)
+        server = await webhook.start_server(processor, WEBHOOK_PORT, urlparse(WEBHOOK_URL).path or '/',
+                                            WEBHOOK_SECRET, host=WEBHOOK_LISTEN)
+        try:
+            await application.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                                              max_connections=WEBHOOK_MAX_CONNECTIONS)
+            await application.start()
+            await stop.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            await processor.join()
+            if application.running:
+                await application.stop()
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def main():
+    if BOT_ROLE == 'worker':
+        asyncio.run(run_worker(*parse_shard(BOT_SHARD)))
+        return
+    if BOT_ROLE == 'fetcher':
+        wait_for_fetcher_lease()
+
+    application = build_application()
+
+    # Schedule the global job; it reschedules itself with an adaptive interval
+    application.job_queue.run_once(poll_listings_job, 0, name='poll_listings')
+
+    # Schedule the retention job to run every day at midnight
+    application.job_queue.run_daily(retention_job, time=datetime.time(hour=0, minute=0, second=0))
+    application.job_queue.run_daily(refresh_districts_job, time=datetime.time(hour=3, minute=0, second=0))
+    if BOT_ROLE == 'fetcher':
+        application.job_queue.run_repeating(renew_lease_job, interval=LEASE_RENEW_INTERVAL, first=LEASE_RENEW_INTERVAL)
+
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+    else:
+        # run_polling removes any webhook left from webhook mode
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
@@ -2,25 +2,235 @@
 
 import sqlite3
 import threading
+import queue
 import logging
 import dateutil.parser
+import os
+import time
+from contextlib import contextmanager
+from parsing import add_numeric_fields
+from feeds import DEFAULT_FEED
+from bloom import RotatingBloomFilter
+import metrics
 
 DB_NAME = 'listings.db'
-db_lock = threading.Lock()
+READER_POOL_SIZE = 4
 logger = logging.getLogger(__name__)
 
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',
+    'PRAGMA mmap_size=67108864',
+    'PRAGMA busy_timeout=5000',
+)
+
+NUMERIC_COLUMNS = (
+    ('price_value', 'INTEGER'),
+    ('rent_value', 'INTEGER'),
+    ('total_price', 'INTEGER'),
+    ('area_value', 'REAL'),
+    ('rooms_value', 'INTEGER'),
+    ('listing_ts', 'INTEGER'),
+)
+
+_local = threading.local()  # Per-thread write connection
+_writers = []  # Every write connection opened, so close_db can close them
+_readers = queue.LifoQueue()
+_reader_count = 0
+_pool_lock = threading.Lock()
+user_listeners = []
+
+LISTING_RETENTION_DAYS = 1
+SENT_RETENTION_DAYS = 3  # Dedup looks back two days
+LOG_RETENTION_DAYS = 7
+DELETE_BATCH_SIZE = 2000  # Rows per retention transaction, so other writers never wait long
+VACUUM_STEP_PAGES = 1000  # Free pages returned to the file system per incremental_vacuum transaction
+ANALYSIS_LIMIT = 1000  # Rows ANALYZE samples per index, so it stays short on a large file
+SENT_WINDOW = 2 * 86400  # Dedup window; keep in step with the "-2 days" in the queries below
+SENT_FILTER_CAPACITY = 200000  # Deliveries expected per window, override with SENT_FILTER_CAPACITY
+SENT_FILTER_FP_RATE = 0.01  # Override with SENT_FILTER_FP_RATE
+BACKFILL_LIMIT = 50  # Most listings /search sends from the database
+FETCH_STATE_RETENTION_DAYS = 2  # Older watermarks fall back to the newest stored listing anyway
+USER_CHANGE_RETENTION_DAYS = 1  # Workers read user_changes as they run and reload every user on start
+LOG_BATCH_SIZE = 500  # listing_log rows a delivery worker reads at a time
+TABLES = ('users', 'user_districts', 'sent_listings', 'listings', 'listing_log', 'fetch_state', 'districts',
+          'sent_listings_daily', 'listing_log_daily', 'user_changes', 'worker_cursors', 'leases')
+
+USER_COLUMNS = ('user_id, min_price, max_price, '
+                '(SELECT group_concat(district_id) FROM user_districts ud WHERE ud.user_id=users.user_id), '
+                'from_owner, use_total_price, is_active, feed_id')
+_user_cache = {}  # user_id -> filters, kept in step with the users table by every write below
+_user_cache_loaded = False
+_user_cache_lock = threading.Lock()  # Writes land on db threads while the event loop reads
+_sent_filter = None  # (user_id, listing_id) pairs sent within SENT_WINDOW; a miss means definitely not sent
+
+
+def _chunks(items, size=500):
+    # Keep IN (...) lists under SQLite's bound parameter limit
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _ensure_columns(c, table, columns):
+    # Lightweight migration for databases created before a column existed
+    c.execute(f'PRAGMA table_info({table})')
+    existing = {row[1] for row in c.fetchall()}
+    added = []
+    for name, column_type in columns:
+        if name not in existing:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+            added.append(name)
+    return added
+
+
+def _connect():
+    conn = sqlite3.connect(DB_NAME, timeout=5, check_same_thread=False, cached_statements=256)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _write_connection():
+    # Writes normally all come from the repository's writer thread. Any other
+    # thread gets its own connection and SQLite's lock (with busy_timeout)
+    # serializes the transactions.
+    conn = getattr(_local, 'writer', None)
+    if conn is None:
+        conn = _local.writer = _connect()
+        # Fsync every commit, so a committed write survives power loss. Group
+        # commit keeps this to one fsync per batch of writes.
+        conn.execute('PRAGMA synchronous=FULL')
+        with _pool_lock:
+            _writers.append(conn)
+    return conn
+
+
+@contextmanager
+def _write():
+    """
+    Run a block on this thread's write connection and commit it as one transaction.
+
+    Inside run_batch the block runs in a savepoint of the batch's transaction
+    instead: a failure undoes only this block, and the commit happens once
+    for the whole batch.
+    """
+    writer = _write_connection()
+    if getattr(_local, 'batch', False):
+        c = writer.cursor()
+        c.execute('SAVEPOINT write')
+        try:
+            yield c
+        except BaseException:
+            c.execute('ROLLBACK TO write')
+            raise
+        finally:
+            c.execute('RELEASE write')
+        return
+
+    try:
+        yield writer.cursor()
+        writer.commit()
+    except BaseException:
+        writer.rollback()
+        raise
+
+
+def run_batch(operations):
+    """
+    Run (func, args, kwargs) write operations in one transaction with a single
+    commit. Returns a (result, exception) pair per operation; an operation that
+    fails does not affect the others. Raises sqlite3.Error if the commit fails,
+    in which case none of them were stored.
+    """
+    writer = _write_connection()
+    results = []
+    _local.batch = True
+    try:
+        writer.execute('BEGIN')
+        for func, args, kwargs in operations:
+            try:
+                results.append((func(*args, **kwargs), None))
+            except Exception as e:
+                results.append((None, e))
+        writer.commit()
+    except sqlite3.Error:
+        writer.rollback()
+        # Cache updates made by the operations were never committed
+        load_user_cache()
+        raise
+    finally:
+        _local.batch = False
+    return results
+
+
+@contextmanager
+def _read():
+    """
+    Borrow a connection from the reader pool for the duration of the block.
+    """
+    global _reader_count
+    try:
+        conn = _readers.get_nowait()
+    except queue.Empty:
+        with _pool_lock:
+            create = _reader_count < READER_POOL_SIZE
+            if create:
+                _reader_count += 1
+        if create:
+            try:
+                conn = _connect()
+                conn.execute('PRAGMA query_only=ON')
+            except sqlite3.Error:
+                with _pool_lock:
+                    _reader_count -= 1
+                raise
+        else:
+            conn = _readers.get()
+    try:
+        yield conn.cursor()
+    finally:
+        _readers.put(conn)
+
+
+def close_db():
+    global _local, _reader_count
+    with _pool_lock:
+        for conn in _writers:
+            conn.close()
+        _writers.clear()
+        _local = threading.local()
+        while True:
+            try:
+                _readers.get_nowait().close()
+            except queue.Empty:
+                break
+        _reader_count = 0
+
+def _enable_incremental_vacuum():
+    # Lets compact_db free pages in short steps. Switching needs one full
+    # VACUUM (WAL mode has already written the header of a new file), so it
+    # is done here, before the bot runs
+    writer = _write_connection()
+    if writer.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        return
+    logger.info("Converting the database to incremental vacuum")
+    writer.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    writer.execute('VACUUM')
+
 def init_db():
     logger.info("Initializing the database.")
-    with db_lock:
-        try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
+    try:
+        _enable_incremental_vacuum()
+        with _write() as c:
             c.execute('''
                 CREATE TABLE IF NOT EXISTS users (
                     user_id INTEGER PRIMARY KEY,
                     min_price INTEGER,
                     max_price INTEGER,
-                    districts TEXT,
+                    districts TEXT,  -- Superseded by user_districts, kept for older databases
                     is_active INTEGER DEFAULT 0,
                     from_owner INTEGER DEFAULT 0,
                     use_total_price INTEGER DEFAULT 0
@@ -63,243 +273,852 @@ def init_db():
                             added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                         )
                 ''')
-            conn.commit()
-        except sqlite3.Error as e:
-            logger.error(f"Database error during initialization: {e}")
-        finally:
-            conn.close()
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS fetch_state (
+                    query_key TEXT PRIMARY KEY,
+                    watermark TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            # Daily aggregates of rows past their retention period
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS sent_listings_daily (
+                    day TEXT,
+                    user_id INTEGER,
+                    messages INTEGER,
+                    PRIMARY KEY (day, user_id)
+                )
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS listing_log_daily (
+                    day TEXT PRIMARY KEY,
+                    listings INTEGER
+                )
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS districts (
+                    feed_id TEXT,
+                    district_id TEXT,
+                    name TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (feed_id, district_id)
+                )
+            ''')
+            # Coordination between a fetcher and sharded delivery workers (see worker.py)
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS user_changes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    changed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS worker_cursors (
+                    worker TEXT PRIMARY KEY,
+                    log_id INTEGER,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT,
+                    expires_at REAL
+                )
+            ''')
+            c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='user_districts'")
+            migrate_districts = c.fetchone() is None
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS user_districts (
+                    user_id INTEGER,
+                    district_id TEXT,
+                    PRIMARY KEY (user_id, district_id)
+                ) WITHOUT ROWID
+            ''')
+            # Reverse lookup: which users watch a district
+            c.execute('CREATE INDEX IF NOT EXISTS idx_user_districts_district ON user_districts (district_id, user_id)')
+            if migrate_districts:
+                _migrate_user_districts(c)
+            added = _ensure_columns(c, 'listings', NUMERIC_COLUMNS)
+            if added:
+                _backfill_numeric_columns(c)
+            _ensure_columns(c, 'listings', [('rendered_text', 'TEXT')])
+            # Everything stored before feeds existed came from the default feed
+            if _ensure_columns(c, 'listings', [('feed_id', 'TEXT')]):
+                c.execute('UPDATE listings SET feed_id=?', (DEFAULT_FEED,))
+            _ensure_columns(c, 'users', [('feed_id', 'TEXT')])
+            c.execute('CREATE INDEX IF NOT EXISTS idx_listings_feed_listing_ts ON listings (feed_id, listing_ts)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_listings_price_value ON listings (price_value)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_listings_total_price ON listings (total_price)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_listings_listing_ts ON listings (listing_ts)')
+            # Dedup lookups go by user, or by listing across all users
+            c.execute('CREATE INDEX IF NOT EXISTS idx_sent_listings_user_listing ON sent_listings (user_id, listing_id, sent_at)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_sent_listings_listing ON sent_listings (listing_id, user_id)')
+    except sqlite3.Error as e:
+        logger.error(f"Database error during initialization: {e}")
+        return
 
-def get_user_filters(user_id):
-    with db_lock:
+    load_user_cache()
+    load_sent_filter()
+
+def add_user_listener(callback):
+    """
+    Register callback(user_id), called after a user's filters or active flag change.
+    """
+    user_listeners.append(callback)
+
+def _notify_user_changed(user_id):
+    for callback in user_listeners:
         try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            c.execute('SELECT min_price, max_price, districts, from_owner, use_total_price FROM users WHERE user_id=?', (user_id,))
-            result = c.fetchone()
-            if result:
-                min_price, max_price, districts, from_owner, use_total_price = result
-                districts = districts.split(',') if districts else []
-                districts = [d.strip() for d in districts if d.strip()]
-                return {
-                    'min_price': min_price,
-                    'max_price': max_price,
-                    'districts': districts,
-                    'from_owner': bool(from_owner),
-                    'use_total_price': bool(use_total_price)
-                }
-            else:
-                return None
-        except sqlite3.Error as e:
-            logger.error(f"Database error when fetching user filters: {e}")
-            return None
-        finally:
-            conn.close()
+            callback(user_id)
+        except Exception as e:
+            logger.error(f"Error in user change listener: {e}")
+
+def _row_to_filters(row):
+    min_price, max_price, districts, from_owner, use_total_price, is_active, feed_id = row
+    districts = districts.split(',') if districts else []
+    districts = [d.strip() for d in districts if d.strip()]
+    return {
+        'min_price': min_price,
+        'max_price': max_price,
+        'districts': districts,
+        'district_set': frozenset(districts),
+        'from_owner': bool(from_owner),
+        'use_total_price': bool(use_total_price),
+        'is_active': bool(is_active),
+        'feed_id': feed_id or DEFAULT_FEED
+    }
+
+def _copy_filters(filters):
+    # Callers may edit the districts list, so never hand out the cached one
+    return dict(filters, districts=list(filters['districts']))
+
+def load_user_cache():
+    global _user_cache, _user_cache_loaded
+    try:
+        with _read() as c:
+            c.execute(f'SELECT {USER_COLUMNS} FROM users')
+            rows = c.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Database error when loading user cache: {e}")
+        return
+    with _user_cache_lock:
+        _user_cache = {row[0]: _row_to_filters(row[1:]) for row in rows}
+        _user_cache_loaded = True
+    logger.info(f"Loaded filters for {len(_user_cache)} users")
+
+def _select_user(c, user_id):
+    c.execute(f'SELECT {USER_COLUMNS} FROM users WHERE user_id=?', (user_id,))
+    return c.fetchone()
+
+def _user_changed(c, user_id):
+    # Log the change for other processes and return the user's new row
+    c.execute('INSERT INTO user_changes (user_id) VALUES (?)', (user_id,))
+    return _select_user(c, user_id)
+
+def _cache_user(user_id, row):
+    if row:
+        filters = _row_to_filters(row[1:])
+        with _user_cache_lock:
+            _user_cache[user_id] = filters
+    else:
+        with _user_cache_lock:
+            _user_cache.pop(user_id, None)
+
+def _migrate_user_districts(c):
+    # Copy the comma-joined users.districts column into user_districts
+    c.execute("SELECT user_id, districts FROM users WHERE districts IS NOT NULL AND districts != ''")
+    rows = [(user_id, district_id.strip()) for user_id, districts in c.fetchall()
+            for district_id in districts.split(',') if district_id.strip()]
+    c.executemany('INSERT OR IGNORE INTO user_districts (user_id, district_id) VALUES (?, ?)', rows)
+    logger.info(f"Migrated {len(rows)} district selections to user_districts")
+
+def _set_user_districts(c, user_id, districts):
+    c.execute('DELETE FROM user_districts WHERE user_id=?', (user_id,))
+    c.executemany('INSERT OR IGNORE INTO user_districts (user_id, district_id) VALUES (?, ?)',
+                  [(user_id, district_id) for district_id in districts])
+
+def _backfill_numeric_columns(c):
+    c.execute('SELECT id, price, rent_additional, area, rooms, listing_time FROM listings')
+    rows = c.fetchall()
+    updates = []
+    for listing_id, price, rent_additional, area, rooms, listing_time in rows:
+        listing = add_numeric_fields({'price': price, 'rent_additional': rent_additional, 'area': area, 'rooms': rooms})
+        listing_ts = int(dateutil.parser.parse(listing_time).timestamp()) if listing_time else None
+        updates.append((listing['price_value'], listing['rent_value'], listing['total_price'],
+                        listing['area_value'], listing['rooms_value'], listing_ts, listing_id))
+    c.executemany('UPDATE listings SET price_value=?, rent_value=?, total_price=?, area_value=?, rooms_value=?, listing_ts=? '
+                  'WHERE id=?', updates)
+    logger.info(f"Backfilled numeric columns for {len(updates)} listings")
+
+def get_user_filters(user_id):
+    if _user_cache_loaded:
+        filters = _user_cache.get(user_id)
+        return _copy_filters(filters) if filters else None
+
+    try:
+        with _read() as c:
+            result = _select_user(c, user_id)
+    except sqlite3.Error as e:
+        logger.error(f"Database error when fetching user filters: {e}")
+        return None
+
+    if result:
+        return _row_to_filters(result[1:])
+    else:
+        return None
+
+def get_active_user_filters():
+    """
+    Return {user_id: filters} for every active user.
+    """
+    if _user_cache_loaded:
+        with _user_cache_lock:
+            users = list(_user_cache.items())
+        return {user_id: _copy_filters(filters) for user_id, filters in users if filters['is_active']}
+
+    try:
+        with _read() as c:
+            c.execute(f'SELECT {USER_COLUMNS} FROM users WHERE is_active=1')
+            rows = c.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Database error when fetching active user filters: {e}")
+        return {}
+    return {row[0]: _row_to_filters(row[1:]) for row in rows}
 
 def set_user_filters(user_id, min_price=None, max_price=None, districts=None, from_owner=None, use_total_price=None):
-    with db_lock:
-        try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            c.execute('SELECT user_id FROM users WHERE user_id=?', (user_id,))
-            if c.fetchone():
-                updates = []
-                params = []
-                if min_price is not None:
-                    updates.append('min_price=?')
-                    params.append(min_price)
-                if max_price is not None:
-                    updates.append('max_price=?')
-                    params.append(max_price)
-                if districts is not None:
-                    districts_str = ','.join(districts)
-                    updates.append('districts=?')
-                    params.append(districts_str)
-                if from_owner is not None:
-                    updates.append('from_owner=?')
-                    params.append(int(from_owner))
-                if use_total_price is not None:
-                    updates.append('use_total_price=?')
-                    params.append(int(use_total_price))
-                params.append(user_id)
-                sql = 'UPDATE users SET ' + ', '.join(updates) + ' WHERE user_id=?'
-                c.execute(sql, params)
-            else:
-                districts_str = ','.join(districts) if districts else ''
-                c.execute('INSERT INTO users (user_id, min_price, max_price, districts, is_active, from_owner, use_total_price) VALUES (?, ?, ?, ?, 0, ?, ?)',
-                          (user_id, min_price, max_price, districts_str, int(from_owner or 0), int(use_total_price or 0)))
-            conn.commit()
-        except sqlite3.Error as e:
-            logger.error(f"Database error when setting user filters: {e}")
-        finally:
-            conn.close()
+    try:
+        # One upsert: new users get every value, existing users only the ones given
+        values = {'min_price': min_price, 'max_price': max_price,
+                  'from_owner': None if from_owner is None else int(from_owner),
+                  'use_total_price': None if use_total_price is None else int(use_total_price)}
+        updates = [f'{column}=excluded.{column}' for column, value in values.items() if value is not None]
+        conflict = f'DO UPDATE SET {", ".join(updates)}' if updates else 'DO NOTHING'
+        with _write() as c:
+            c.execute('INSERT INTO users (user_id, min_price, max_price, from_owner, use_total_price, is_active) '
+                      f'VALUES (?, ?, ?, ?, ?, 0) ON CONFLICT(user_id) {conflict}',
+                      (user_id, min_price, max_price, values['from_owner'] or 0, values['use_total_price'] or 0))
+            if districts is not None:
+                _set_user_districts(c, user_id, districts)
+            row = _user_changed(c, user_id)
+        _cache_user(user_id, row)
+    except sqlite3.Error as e:
+        logger.error(f"Database error when setting user filters: {e}")
+    else:
+        _notify_user_changed(user_id)
 
 
 def reset_user_filters(user_id):
-    with db_lock:
-        try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            c.execute('UPDATE users SET min_price=NULL, max_price=NULL, districts=NULL WHERE user_id=?', (user_id,))
-            conn.commit()
-        except sqlite3.Error as e:
-            logger.error(f"Database error when resetting user filters: {e}")
-        finally:
-            conn.close()
+    try:
+        with _write() as c:
+            c.execute('UPDATE users SET min_price=NULL, max_price=NULL WHERE user_id=?', (user_id,))
+            c.execute('DELETE FROM user_districts WHERE user_id=?', (user_id,))
+            row = _user_changed(c, user_id)
+        _cache_user(user_id, row)
+    except sqlite3.Error as e:
+        logger.error(f"Database error when resetting user filters: {e}")
+    else:
+        _notify_user_changed(user_id)
 
-def has_user_received_listing(user_id, listing_id):
-    with db_lock:
-        try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            c.execute('SELECT id FROM sent_listings WHERE user_id=? AND listing_id=? AND sent_at > datetime("now", "-2 days")', (user_id, listing_id))
-            result = c.fetchone()
-            return result is not None
-        except sqlite3.Error as e:
-            logger.error(f"Database error when checking sent listings: {e}")
-            return False
-        finally:
-            conn.close()
+def add_user_district(user_id, district_id):
+    try:
+        with _write() as c:
+            c.execute('INSERT OR IGNORE INTO user_districts (user_id, district_id) VALUES (?, ?)', (user_id, district_id))
+            row = _user_changed(c, user_id)
+        _cache_user(user_id, row)
+    except sqlite3.Error as e:
+        logger.error(f"Database error when adding user district: {e}")
+    else:
+        _notify_user_changed(user_id)
 
-def mark_listing_as_sent(user_id, listing_id):
-    with db_lock:
-        try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            c.execute('INSERT INTO sent_listings (user_id, listing_id, sent_at) VALUES (?, ?, CURRENT_TIMESTAMP)', (user_id, listing_id))
-            conn.commit()
-        except sqlite3.Error as e:
-            logger.error(f"Database error when marking listing as sent: {e}")
-        finally:
-            conn.close()
+def remove_user_district(user_id, district_id):
+    try:
+        with _write() as c:
+            c.execute('DELETE FROM user_districts WHERE user_id=? AND district_id=?', (user_id, district_id))
+            row = _user_changed(c, user_id)
+        _cache_user(user_id, row)
+    except sqlite3.Error as e:
+        logger.error(f"Database error when removing user district: {e}")
+    else:
+        _notify_user_changed(user_id)
+
+def get_latest_user_change():
+    try:
+        with _read() as c:
+            c.execute('SELECT COALESCE(MAX(id), 0) FROM user_changes')
+            return c.fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"Database error when getting the latest user change: {e}")
+        return 0
+
+def reload_changed_users(after_id):
+    """
+    Refresh the cached filters of users changed, possibly by another process,
+    since user_changes id after_id and notify the listeners. Returns the
+    newest change id read, to pass in next time.
+    """
+    try:
+        with _read() as c:
+            c.execute('SELECT id, user_id FROM user_changes WHERE id > ? ORDER BY id', (after_id,))
+            changes = c.fetchall()
+            user_ids = list(dict.fromkeys(user_id for _, user_id in changes))
+            rows = {}
+            for chunk in _chunks(user_ids):
+                c.execute(f'SELECT {USER_COLUMNS} FROM users WHERE user_id IN ({",".join("?" * len(chunk))})', chunk)
+                rows.update((row[0], row) for row in c.fetchall())
+    except sqlite3.Error as e:
+        logger.error(f"Database error when reloading changed users: {e}")
+        return after_id
+
+    for user_id in user_ids:
+        _cache_user(user_id, rows.get(user_id))
+        _notify_user_changed(user_id)
+    return changes[-1][0] if changes else after_id
+
+def load_sent_filter():
+    """
+    Rebuild the in-memory sent-listings filter from the last SENT_WINDOW of deliveries.
+    """
+    global _sent_filter
+    started = time.monotonic()
+    sent_filter = RotatingBloomFilter(int(os.getenv('SENT_FILTER_CAPACITY', SENT_FILTER_CAPACITY)),
+                                      float(os.getenv('SENT_FILTER_FP_RATE', SENT_FILTER_FP_RATE)),
+                                      SENT_WINDOW)
+    try:
+        with _read() as c:
+            c.execute('SELECT user_id, listing_id FROM sent_listings WHERE sent_at > datetime("now", ?)',
+                      (f'-{SENT_WINDOW} seconds',))
+            for user_id, listing_id in c:
+                sent_filter.add(f"{user_id}:{listing_id}")
+    except sqlite3.Error as e:
+        logger.error(f"Database error when loading the sent listings filter: {e}")
+        return
+    _sent_filter = sent_filter
+    logger.info(f"Sent listings filter loaded in {time.monotonic() - started:.1f} s "
+                f"({sent_filter.memory_bytes // 1024} KiB)")
+
+def disable_sent_filter():
+    """
+    Check every pair in the database. Needed when other processes also send
+    to this process's users, since their deliveries never reach the filter.
+    """
+    global _sent_filter
+    _sent_filter = None
+
+def _maybe_sent(user_id, listing_id):
+    # Without a filter every pair has to be checked in the database
+    return _sent_filter is None or f"{user_id}:{listing_id}" in _sent_filter
+
+def _remember_sent(pairs):
+    if _sent_filter is not None:
+        for user_id, listing_id in pairs:
+            _sent_filter.add(f"{user_id}:{listing_id}")
+
+@metrics.DEDUP_SECONDS.timed
+def get_sent_listing_ids_for_users(listing_ids_by_user):
+    """
+    Return {user_id: set of listing_ids} already sent in the last two days,
+    for the given {user_id: listing_ids}.
+    """
+    candidates = {}
+    skipped = 0
+    for user_id, listing_ids in listing_ids_by_user.items():
+        for listing_id in listing_ids:
+            if _maybe_sent(user_id, listing_id):
+                candidates.setdefault(user_id, set()).add(listing_id)
+            else:
+                skipped += 1
+    metrics.DEDUP_FILTER_SKIPS.inc(skipped)
+
+    sent = {}
+    if not candidates:
+        return sent
+    try:
+        with _read() as c:
+            for chunk in _chunks({listing_id for ids in candidates.values() for listing_id in ids}):
+                placeholders = ','.join('?' * len(chunk))
+                c.execute(f'SELECT user_id, listing_id FROM sent_listings WHERE listing_id IN ({placeholders}) '
+                          f'AND sent_at > datetime("now", "-2 days")', chunk)
+                for user_id, listing_id in c.fetchall():
+                    if listing_id in candidates.get(user_id, ()):
+                        sent.setdefault(user_id, set()).add(listing_id)
+    except sqlite3.Error as e:
+        logger.error(f"Database error when checking sent listings: {e}")
+    return sent
+
+def mark_listings_as_sent(pairs):
+    """
+    Record a batch of (user_id, listing_id) deliveries in one transaction.
+    Returns False if nothing could be stored.
+    """
+    try:
+        with _write() as c:
+            c.executemany('INSERT INTO sent_listings (user_id, listing_id, sent_at) VALUES (?, ?, CURRENT_TIMESTAMP)', pairs)
+    except sqlite3.Error as e:
+        logger.error(f"Database error when marking listings as sent: {e}")
+        return False
+    _remember_sent(pairs)
+    return True
 
 def clean_old_listings():
-    with db_lock:
-        try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            c.execute('DELETE FROM listings WHERE listing_time < datetime("now", "-1 days")')
-            conn.commit()
-        except sqlite3.Error as e:
-            logger.error(f"Database error when cleaning old listings: {e}")
-        finally:
-            conn.close()
+    """
+    Delete listings older than LISTING_RETENTION_DAYS in batches. Returns the number deleted.
+    """
+    cutoff = int(time.time()) - LISTING_RETENTION_DAYS * 86400
+    deleted = 0
+    try:
+        while True:
+            with _write() as c:
+                c.execute('DELETE FROM listings WHERE id IN (SELECT id FROM listings WHERE listing_ts < ? LIMIT ?)',
+                          (cutoff, DELETE_BATCH_SIZE))
+                count = c.rowcount
+            deleted += count
+            if count < DELETE_BATCH_SIZE:
+                break
+    except sqlite3.Error as e:
+        logger.error(f"Database error when cleaning old listings: {e}")
+    return deleted
+
+def _roll_up(table, time_column, days, rollup_sql):
+    """
+    Fold rows of an append-only table older than the given number of days into
+    daily aggregates and delete them, a batch of ids per transaction.
+
+    Ids grow with the timestamp, so the rows to remove are the ids below the
+    first one still inside the retention window.
+    """
+    with _read() as c:
+        c.execute(f'SELECT MIN(id) FROM {table} WHERE {time_column} >= datetime("now", ?)', (f'-{days} days',))
+        end_id = c.fetchone()[0]
+        if end_id is None:
+            c.execute(f'SELECT MAX(id) + 1 FROM {table}')
+            end_id = c.fetchone()[0]
+        c.execute(f'SELECT MIN(id) FROM {table}')
+        start_id = c.fetchone()[0]
+    if start_id is None or end_id is None:
+        return 0
+
+    removed = 0
+    while start_id < end_id:
+        batch_end = min(start_id + DELETE_BATCH_SIZE, end_id)
+        with _write() as c:
+            c.execute(rollup_sql, (start_id, batch_end))
+            c.execute(f'DELETE FROM {table} WHERE id >= ? AND id < ?', (start_id, batch_end))
+            removed += c.rowcount
+        start_id = batch_end
+    return removed
+
+def prune_sent_listings():
+    """
+    Roll deliveries older than SENT_RETENTION_DAYS up into sent_listings_daily.
+    """
+    try:
+        return _roll_up('sent_listings', 'sent_at', SENT_RETENTION_DAYS, '''
+            INSERT INTO sent_listings_daily (day, user_id, messages)
+            SELECT date(sent_at), user_id, COUNT(*) FROM sent_listings WHERE id >= ? AND id < ?
+            GROUP BY date(sent_at), user_id
+            ON CONFLICT(day, user_id) DO UPDATE SET messages = messages + excluded.messages
+        ''')
+    except sqlite3.Error as e:
+        logger.error(f"Database error when pruning sent listings: {e}")
+        return 0
+
+def prune_listing_log():
+    """
+    Roll listing_log rows older than LOG_RETENTION_DAYS up into listing_log_daily.
+    """
+    try:
+        return _roll_up('listing_log', 'added_at', LOG_RETENTION_DAYS, '''
+            INSERT INTO listing_log_daily (day, listings)
+            SELECT date(added_at), COUNT(*) FROM listing_log WHERE id >= ? AND id < ?
+            GROUP BY date(added_at)
+            ON CONFLICT(day) DO UPDATE SET listings = listings + excluded.listings
+        ''')
+    except sqlite3.Error as e:
+        logger.error(f"Database error when pruning listing log: {e}")
+        return 0
+
+def prune_fetch_state():
+    """
+    Delete watermarks not saved for FETCH_STATE_RETENTION_DAYS, mostly of
+    queries the planner no longer produces.
+    """
+    try:
+        with _write() as c:
+            c.execute('DELETE FROM fetch_state WHERE updated_at < datetime("now", ?)',
+                      (f'-{FETCH_STATE_RETENTION_DAYS} days',))
+            return c.rowcount
+    except sqlite3.Error as e:
+        logger.error(f"Database error when pruning fetch state: {e}")
+        return 0
+
+def prune_user_changes():
+    """
+    Delete user_changes rows older than USER_CHANGE_RETENTION_DAYS in batches.
+    """
+    deleted = 0
+    try:
+        while True:
+            with _write() as c:
+                c.execute('DELETE FROM user_changes WHERE id IN (SELECT id FROM user_changes '
+                          'WHERE changed_at < datetime("now", ?) LIMIT ?)',
+                          (f'-{USER_CHANGE_RETENTION_DAYS} days', DELETE_BATCH_SIZE))
+                count = c.rowcount
+            deleted += count
+            if count < DELETE_BATCH_SIZE:
+                break
+    except sqlite3.Error as e:
+        logger.error(f"Database error when pruning user changes: {e}")
+    return deleted
+
+def get_table_sizes():
+    """
+    Return ({table: row count}, database file size in bytes, free bytes inside the file).
+    """
+    rows = {}
+    try:
+        with _read() as c:
+            for table in TABLES:
+                c.execute(f'SELECT COUNT(*) FROM {table}')
+                rows[table] = c.fetchone()[0]
+            c.execute('PRAGMA page_size')
+            page_size = c.fetchone()[0]
+            c.execute('PRAGMA page_count')
+            page_count = c.fetchone()[0]
+            c.execute('PRAGMA freelist_count')
+            free_pages = c.fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"Database error when reading table sizes: {e}")
+        return rows, 0, 0
+    return rows, page_count * page_size, free_pages * page_size
+
+def compact_db():
+    """
+    Refresh planner statistics and return free pages to the file system, in
+    steps short enough that the writer thread never waits long for the lock.
+    """
+    try:
+        with _write() as c:
+            c.execute(f'PRAGMA analysis_limit={ANALYSIS_LIMIT}')
+            c.execute('ANALYZE')
+        freed = 0
+        while True:
+            with _write() as c:
+                c.execute('PRAGMA freelist_count')
+                before = c.fetchone()[0]
+                c.execute(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})').fetchall()
+                c.execute('PRAGMA freelist_count')
+                after = c.fetchone()[0]
+            freed += before - after
+            if not after or after >= before:
+                break
+        if freed:
+            logger.info(f"Returned {freed} free pages to the file system")
+            _write_connection().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    except sqlite3.Error as e:
+        logger.error(f"Database error when compacting the database: {e}")
+
+def run_retention():
+    """
+    Apply every retention rule, compact the file and report table sizes.
+    Safe to run in a worker thread.
+    """
+    deleted = clean_old_listings()
+    sent = prune_sent_listings()
+    logged = prune_listing_log()
+    prune_user_changes()
+    prune_fetch_state()
+    compact_db()
+    rows, size, free = get_table_sizes()
+    logger.info(f"Retention removed {deleted} listings, {sent} sent_listings and {logged} listing_log rows")
+    logger.info("Table sizes: " + ', '.join(f"{table}={count}" for table, count in rows.items()) +
+                f"; file {size / 1e6:.1f} MB, {free / 1e6:.1f} MB free")
+    return rows, size
 
 def set_user_active(user_id, is_active):
-    with db_lock:
-        try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
+    try:
+        with _write() as c:
             c.execute('UPDATE users SET is_active=? WHERE user_id=?', (int(is_active), user_id))
-            conn.commit()
-        except sqlite3.Error as e:
-            logger.error(f"Database error when setting user active status: {e}")
-        finally:
-            conn.close()
+            row = _user_changed(c, user_id)
+        _cache_user(user_id, row)
+    except sqlite3.Error as e:
+        logger.error(f"Database error when setting user active status: {e}")
+    else:
+        _notify_user_changed(user_id)
+
+def set_user_feed(user_id, feed_id):
+    """
+    Move a user to another feed. District ids belong to a city, so the
+    user's districts are cleared.
+    """
+    try:
+        with _write() as c:
+            c.execute('UPDATE users SET feed_id=? WHERE user_id=?', (feed_id, user_id))
+            c.execute('DELETE FROM user_districts WHERE user_id=?', (user_id,))
+            row = _user_changed(c, user_id)
+        _cache_user(user_id, row)
+    except sqlite3.Error as e:
+        logger.error(f"Database error when setting user feed: {e}")
+    else:
+        _notify_user_changed(user_id)
 
 def get_active_users():
-    with db_lock:
-        try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
+    if _user_cache_loaded:
+        with _user_cache_lock:
+            users = list(_user_cache.items())
+        return [user_id for user_id, filters in users if filters['is_active']]
+
+    try:
+        with _read() as c:
             c.execute('SELECT user_id FROM users WHERE is_active=1')
-            result = c.fetchall()
-            return [row[0] for row in result]
-        except sqlite3.Error as e:
-            logger.error(f"Database error when fetching active users: {e}")
-            return []
-        finally:
-            conn.close()
+            return [row[0] for row in c.fetchall()]
+    except sqlite3.Error as e:
+        logger.error(f"Database error when fetching active users: {e}")
+        return []
 
-def save_listings_to_db(listings):
-    with db_lock:
-        try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
+LISTING_COLUMNS = (
+    'id', 'title', 'url', 'price', 'rent_additional', 'location',
+    'region_id', 'region_name', 'region_normalized_name',
+    'district_id', 'district_name', 'area', 'rooms',
+    'is_business', 'description', 'listing_time',
+    'price_value', 'rent_value', 'total_price', 'area_value', 'rooms_value', 'listing_ts',
+    'rendered_text', 'feed_id'
+)
+INSERT_LISTING_SQL = (f'INSERT OR IGNORE INTO listings ({", ".join(LISTING_COLUMNS)}) '
+                      f'VALUES ({", ".join("?" * len(LISTING_COLUMNS))})')
+
+def _listing_row(listing):
+    row = dict(listing)
+    row['is_business'] = int(listing.get('is_business', False))
+    row['listing_time'] = listing['listing_time'].isoformat() if listing.get('listing_time') else None
+    row['feed_id'] = listing.get('feed_id') or DEFAULT_FEED
+    return tuple(row.get(column) for column in LISTING_COLUMNS)
+
+@metrics.SAVE_SECONDS.timed
+def save_listings_to_db(listings, watermark_key=None, watermark=None):
+    """
+    Store the listings that are not in the database yet and return their ids.
+    When watermark_key is given, the query's watermark is advanced in the
+    same transaction. On a database error nothing is stored and None is returned.
+    """
+    new_listings = {}
+    try:
+        with _write() as c:
+            existing = set()
+            ids = list(dict.fromkeys(listing['id'] for listing in listings))
+            for chunk in _chunks(ids):
+                placeholders = ','.join('?' * len(chunk))
+                c.execute(f'SELECT id FROM listings WHERE id IN ({placeholders})', chunk)
+                existing.update(row[0] for row in c.fetchall())
             for listing in listings:
-                c.execute('SELECT 1 FROM listings WHERE id=?', (listing.get('id'),))
-                if not c.fetchone():
-                    c.execute('''
-                        INSERT INTO listings (
-                            id, title, url, price, rent_additional, location,
-                            region_id, region_name, region_normalized_name,
-                            district_id, district_name, area, rooms,
-                            is_business, description, listing_time
-                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        listing.get('id'),
-                        listing.get('title'),
-                        listing.get('url'),
-                        listing.get('price'),
-                        listing.get('rent_additional'),
-                        listing.get('location'),
-                        listing.get('region_id'),
-                        listing.get('region_name'),
-                        listing.get('region_normalized_name'),
-                        listing.get('district_id'),
-                        listing.get('district_name'),
-                        listing.get('area'),
-                        listing.get('rooms'),
-                        int(listing.get('is_business', False)),
-                        listing.get('description'),
-                        listing.get('listing_time').isoformat() if listing.get('listing_time') else None
-                    ))
-                    c.execute('INSERT INTO listing_log (listing_id) VALUES (?)', (listing.get('id'),))
-            conn.commit()
-        except sqlite3.Error as e:
-            logger.error(f"Database error when saving listings: {e}")
-        finally:
-            conn.close()
+                if listing['id'] not in existing:
+                    new_listings.setdefault(listing['id'], listing)
 
-def get_listings_from_db():
-    with db_lock:
-        try:
-            conn = sqlite3.connect(DB_NAME)
-            conn.row_factory = sqlite3.Row
-            c = conn.cursor()
-            c.execute('SELECT * FROM listings WHERE listing_time > datetime("now", "-1 days")')
-            rows = c.fetchall()
-            listings = []
-            for row in rows:
+            c.executemany(INSERT_LISTING_SQL, [_listing_row(listing) for listing in new_listings.values()])
+            c.executemany('INSERT INTO listing_log (listing_id) VALUES (?)', [(listing_id,) for listing_id in new_listings])
+            if watermark_key and watermark:
+                c.execute('INSERT INTO fetch_state (query_key, watermark, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP) '
+                          'ON CONFLICT(query_key) DO UPDATE SET watermark=excluded.watermark, updated_at=excluded.updated_at',
+                          (watermark_key, watermark.isoformat()))
+    except sqlite3.Error as e:
+        logger.error(f"Database error when saving listings: {e}")
+        return None
+    return set(new_listings)
+
+def iter_backfill_listings(user_id, filters, limit=BACKFILL_LIMIT, days=LISTING_RETENTION_DAYS):
+    """
+    Yield the stored listings that match a user's filters and were not sent to
+    them in the last two days, newest first, at most limit of them.
+
+    Filtering, the sent check and the ordering all run in SQLite, and rows are
+    read from the cursor as the caller consumes them.
+    """
+    price_column = 'total_price' if filters.get('use_total_price') else 'price_value'
+    clauses = ['feed_id=?', 'listing_ts >= ?', f'{price_column} IS NOT NULL']
+    params = [filters.get('feed_id') or DEFAULT_FEED, int(time.time()) - days * 86400]
+    if filters.get('min_price') is not None:
+        clauses.append(f'{price_column} >= ?')
+        params.append(filters['min_price'])
+    if filters.get('max_price') is not None:
+        clauses.append(f'{price_column} <= ?')
+        params.append(filters['max_price'])
+    if filters.get('districts'):
+        clauses.append(f'district_id IN ({",".join("?" * len(filters["districts"]))})')
+        params.extend(filters['districts'])
+    if filters.get('from_owner'):
+        clauses.append('is_business=0')
+    clauses.append('NOT EXISTS (SELECT 1 FROM sent_listings s WHERE s.user_id=? AND s.listing_id=listings.id '
+                   'AND s.sent_at > datetime("now", "-2 days"))')
+    params.append(user_id)
+    params.append(limit)
+
+    # The description is only needed to render rows stored before rendered_text existed
+    sql = (f'SELECT id, title, url, price, rent_additional, district_id, district_name, area, rooms, is_business, '
+           f'listing_ts, feed_id, rendered_text, CASE WHEN rendered_text IS NULL THEN description END AS description '
+           f'FROM listings WHERE {" AND ".join(clauses)} ORDER BY listing_ts DESC LIMIT ?')
+    try:
+        with _read() as c:
+            c.row_factory = sqlite3.Row
+            c.execute(sql, params)
+            for row in c:
                 listing = dict(row)
                 listing['is_business'] = bool(listing['is_business'])
-                # Parse listing_time back to datetime object
-                if listing.get('listing_time'):
-                    listing['listing_time'] = dateutil.parser.parse(listing['listing_time'])
-                listings.append(listing)
-            return listings
-        except sqlite3.Error as e:
-            logger.error(f"Database error when fetching listings: {e}")
-            return []
-        finally:
-            conn.close()
+                yield listing
+    except sqlite3.Error as e:
+        logger.error(f"Database error when selecting backfill listings: {e}")
+
+def get_logged_listings(after_id, limit=LOG_BATCH_SIZE):
+    """
+    Return (newest listing_log id read, listings) for listings logged after
+    after_id, oldest first. listing_log is the feed of new listings that
+    delivery workers follow.
+    """
+    sql = ('SELECT g.id AS log_id, l.id, title, url, price, rent_additional, district_id, district_name, area, rooms, '
+           'is_business, price_value, total_price, listing_ts, feed_id, rendered_text, '
+           'CASE WHEN rendered_text IS NULL THEN description END AS description '
+           'FROM listing_log g JOIN listings l ON l.id=g.listing_id WHERE g.id > ? ORDER BY g.id LIMIT ?')
+    try:
+        with _read() as c:
+            c.row_factory = sqlite3.Row
+            c.execute(sql, (after_id, limit))
+            rows = c.fetchall()
+    except sqlite3.Error as e:
+        logger.error(f"Database error when reading logged listings: {e}")
+        return after_id, []
+
+    listings = []
+    for row in rows:
+        listing = dict(row)
+        after_id = listing.pop('log_id')
+        listing['is_business'] = bool(listing['is_business'])
+        listings.append(listing)
+    return after_id, listings
+
+def get_log_id_before(seconds):
+    """
+    Return the id of the last listing_log row added more than seconds ago,
+    so reading after it covers the listings logged since.
+    """
+    try:
+        with _read() as c:
+            c.execute('SELECT MIN(id) - 1 FROM listing_log WHERE added_at >= datetime("now", ?)', (f'-{seconds} seconds',))
+            log_id = c.fetchone()[0]
+            if log_id is None:
+                c.execute('SELECT COALESCE(MAX(id), 0) FROM listing_log')
+                log_id = c.fetchone()[0]
+            return log_id
+    except sqlite3.Error as e:
+        logger.error(f"Database error when reading listing_log: {e}")
+        return None
+
+def get_worker_cursor(worker):
+    """
+    Return the listing_log id a delivery worker has read up to. A new worker
+    starts at the end of the log.
+    """
+    try:
+        with _read() as c:
+            c.execute('SELECT log_id FROM worker_cursors WHERE worker=?', (worker,))
+            row = c.fetchone()
+            if row is None:
+                c.execute('SELECT COALESCE(MAX(id), 0) FROM listing_log')
+                row = c.fetchone()
+            return row[0]
+    except sqlite3.Error as e:
+        logger.error(f"Database error when getting worker cursor: {e}")
+        return None
+
+def set_worker_cursor(worker, log_id):
+    try:
+        with _write() as c:
+            c.execute('INSERT INTO worker_cursors (worker, log_id, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP) '
+                      'ON CONFLICT(worker) DO UPDATE SET log_id=excluded.log_id, updated_at=excluded.updated_at',
+                      (worker, log_id))
+    except sqlite3.Error as e:
+        logger.error(f"Database error when setting worker cursor: {e}")
+
+def acquire_lease(name, holder, ttl):
+    """
+    Take the named lease for ttl seconds if it is free or expired, or renew
+    it if holder already has it. Returns True while holder owns the lease,
+    False if another holder has it, or None on a database error.
+    """
+    now = time.time()
+    try:
+        with _write() as c:
+            c.execute('INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) '
+                      'ON CONFLICT(name) DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at '
+                      'WHERE leases.holder=excluded.holder OR leases.expires_at < ?',
+                      (name, holder, now + ttl, now))
+            return c.rowcount == 1
+    except sqlite3.Error as e:
+        logger.error(f"Database error when acquiring lease {name}: {e}")
+        return None
+
+def release_lease(name, holder):
+    try:
+        with _write() as c:
+            c.execute('DELETE FROM leases WHERE name=? AND holder=?', (name, holder))
+    except sqlite3.Error as e:
+        logger.error(f"Database error when releasing lease {name}: {e}")
 
 def get_new_listings_count():
-    with db_lock:
-        try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
+    try:
+        with _read() as c:
             c.execute('SELECT COUNT(*) FROM listing_log')
-            count = c.fetchone()[0]
-            return count
-        except sqlite3.Error as e:
-            logger.error(f"Database error when counting new listings: {e}")
-            return 0
-        finally:
-            conn.close()
+            return c.fetchone()[0]
+    except sqlite3.Error as e:
+        logger.error(f"Database error when counting new listings: {e}")
+        return 0
 
 def get_latest_listing_time():
-    with db_lock:
-        try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
+    try:
+        with _read() as c:
             c.execute('SELECT MAX(listing_time) FROM listings')
             result = c.fetchone()
-            if result and result[0]:
-                return dateutil.parser.parse(result[0])
-            else:
-                return None
-        except sqlite3.Error as e:
-            logger.error(f"Database error when getting latest listing time: {e}")
-            return None
-        finally:
-            conn.close()
+    except sqlite3.Error as e:
+        logger.error(f"Database error when getting latest listing time: {e}")
+        return None
+
+    if result and result[0]:
+        return dateutil.parser.parse(result[0])
+    else:
+        return None
+
+def get_watermark(query_key):
+    try:
+        with _read() as c:
+            c.execute('SELECT watermark FROM fetch_state WHERE query_key=?', (query_key,))
+            result = c.fetchone()
+    except sqlite3.Error as e:
+        logger.error(f"Database error when getting watermark: {e}")
+        return None
+
+    if result and result[0]:
+        return dateutil.parser.parse(result[0])
+    else:
+        return None
+
+def save_districts(feed_id, district_name_to_id):
+    """
+    Replace the cached district catalog of a feed.
+    """
+    try:
+        with _write() as c:
+            c.execute('DELETE FROM districts WHERE feed_id=?', (feed_id,))
+            c.executemany('INSERT INTO districts (feed_id, district_id, name) VALUES (?, ?, ?)',
+                          [(feed_id, district_id, name) for name, district_id in district_name_to_id.items()])
+    except sqlite3.Error as e:
+        logger.error(f"Database error when saving districts: {e}")
+
+def get_districts(feed_id):
+    """
+    Return the cached {district name: district id} catalog of a feed.
+    """
+    try:
+        with _read() as c:
+            c.execute('SELECT name, district_id FROM districts WHERE feed_id=?', (feed_id,))
+            return dict(c.fetchall())
+    except sqlite3.Error as e:
+        logger.error(f"Database error when getting districts: {e}")
+        return {}
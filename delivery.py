@@ -0,0 +1,196 @@
+# delivery.py
+
+import asyncio
+import inspect
+import logging
+import time
+from collections import deque
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_RATE = 25  # Messages per second across all chats (Telegram allows ~30)
+GLOBAL_BURST = 2  # Keeps any one-second window within GLOBAL_RATE + GLOBAL_BURST
+BACKFILL_RATE = 5  # Part of GLOBAL_RATE a separate fetcher process keeps for /search; workers share the rest
+CHAT_RATE = 1  # Messages per second to a single chat
+CHAT_BURST = 3
+WORKERS = 8
+FLUSH_INTERVAL = 1  # Seconds between batched mark-as-sent writes
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready_in(self):
+        """
+        Seconds until a token is available, without taking it.
+        """
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def reserve(self):
+        """
+        Take a token and return how long the caller must wait before using it.
+        """
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class DeliveryDispatcher:
+    """
+    Sends listings through a pool of workers while honoring Telegram's global
+    and per-chat rate limits.
+
+    Each chat has its own FIFO, so messages to one user stay in order, and a
+    chat that is waiting on its own limit never blocks a worker. A RetryAfter
+    from Telegram pauses all sending for the requested time and the message
+    is retried. Deliveries are reported to on_sent, which may be a coroutine
+    function, in batches. A batch is reported again on the next flush if
+    on_sent raises or returns False.
+    """
+
+    def __init__(self, send, on_sent, workers=WORKERS, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.send = send
+        self.on_sent = on_sent
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_buckets = {}
+        self.chats = {}  # user_id -> deque of listings waiting to be sent
+        self.pending = set()  # (user_id, listing_id) queued or not yet marked as sent
+        self.sent = []
+        self.paused_until = 0
+        self.ready = None
+        self.tasks = []
+
+    def start(self):
+        self.ready = asyncio.Queue()
+        for user_id in self.chats:
+            self.ready.put_nowait(user_id)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.tasks.append(asyncio.create_task(self._flusher()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        await self._flush()
+
+    def submit(self, user_id, listing):
+        """
+        Queue a listing for a user. Returns False if it is already queued.
+        """
+        key = (user_id, listing['id'])
+        if key in self.pending:
+            return False
+        self.pending.add(key)
+
+        messages = self.chats.get(user_id)
+        if messages is None:
+            self.chats[user_id] = deque([listing])
+            if self.ready is not None:
+                self.ready.put_nowait(user_id)
+        else:
+            messages.append(listing)
+        return True
+
+    def queue_depth(self):
+        return sum(len(messages) for messages in self.chats.values())
+
+    def _chat_bucket(self, user_id):
+        bucket = self.chat_buckets.get(user_id)
+        if bucket is None:
+            bucket = self.chat_buckets[user_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _requeue(self, user_id, delay):
+        asyncio.get_running_loop().call_later(delay, self.ready.put_nowait, user_id)
+
+    async def _worker(self):
+        while True:
+            user_id = await self.ready.get()
+            messages = self.chats.get(user_id)
+            if not messages:
+                continue
+
+            chat_bucket = self._chat_bucket(user_id)
+            wait = chat_bucket.ready_in()
+            if wait > 0:
+                self._requeue(user_id, wait)
+                continue
+
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await asyncio.sleep(self.global_bucket.reserve())
+            # Only this worker holds the chat, so its token is still there; taking it
+            # now keeps the per-chat spacing measured at send time
+            chat_bucket.reserve()
+
+            listing = messages[0]
+            sending = asyncio.ensure_future(self.send(user_id, listing))
+            try:
+                await asyncio.shield(sending)
+            except asyncio.CancelledError:
+                # Stopping: a message already on its way is still recorded if it went out
+                await asyncio.wait([sending])
+                if sending.exception() is None:
+                    messages.popleft()
+                    self.sent.append((user_id, listing['id']))
+                raise
+            except RetryAfter as e:
+                logger.warning(f"Rate limited by Telegram, pausing delivery for {e.retry_after}s")
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                self._requeue(user_id, e.retry_after)
+                continue
+            except Exception as e:
+                logger.error(f"Error delivering listing {listing['id']} to user {user_id}: {e}")
+
+            messages.popleft()
+            self.sent.append((user_id, listing['id']))
+            if messages:
+                self._requeue(user_id, chat_bucket.ready_in())
+            else:
+                del self.chats[user_id]
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await self._flush()
+
+    async def _flush(self):
+        if self.sent:
+            sent, self.sent = self.sent, []
+            try:
+                result = self.on_sent(sent)
+                if inspect.isawaitable(result):
+                    result = await result
+            except Exception as e:
+                logger.error(f"Error recording {len(sent)} deliveries: {e}")
+                result = False
+            if result is False:
+                # Keep the batch for the next flush, so deliveries are never forgotten
+                self.sent = sent + self.sent
+            else:
+                self.pending.difference_update(sent)
+
+        # Forget buckets of idle chats that have fully refilled
+        for user_id in [u for u, b in self.chat_buckets.items() if u not in self.chats and b.is_full()]:
+            del self.chat_buckets[user_id]
@@ -0,0 +1,32 @@
+# feeds.py
+#
+# OLX searches the bot can serve. A feed is one category in one city; users
+# pick a feed with /setcity and every feed with subscribers is polled on its
+# own watermarks. Add an entry here to serve another city or category.
+
+DEFAULT_FEED = 'krakow-rent'
+
+FEEDS = {
+    'krakow-rent': {
+        'name': 'Kraków - apartments for rent',
+        'category_id': 15,
+        'region_id': 4,
+        'city_id': 8959,
+    },
+    'warszawa-rent': {
+        'name': 'Warszawa - apartments for rent',
+        'category_id': 15,
+        'region_id': 2,
+        'city_id': 17871,
+    },
+    'wroclaw-rent': {
+        'name': 'Wrocław - apartments for rent',
+        'category_id': 15,
+        'region_id': 3,
+        'city_id': 19701,
+    },
+}
+
+
+def get_feed(feed_id):
+    return FEEDS.get(feed_id) or FEEDS[DEFAULT_FEED]
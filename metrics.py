@@ -0,0 +1,190 @@
+# metrics.py
+
+import asyncio
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LAG_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800)
+
+_registry = []
+
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter",
+                f"{self.name} {_format_value(self.value)}"]
+
+
+class Gauge:
+    """
+    A settable value, or one read from func at scrape time.
+    """
+
+    def __init__(self, name, documentation, func=None):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.value = 0
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, func):
+        self.func = func
+
+    def render(self):
+        value = self.value
+        if self.func is not None:
+            try:
+                value = self.func()
+            except Exception as e:
+                logger.error(f"Error collecting gauge {self.name}: {e}")
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge",
+                f"{self.name} {_format_value(value)}"]
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def timed(self, func):
+        """
+        Decorator timing every call of a sync or async function.
+        """
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with self.time():
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.time():
+                return func(*args, **kwargs)
+        return wrapper
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{le="{_format_value(bound)}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+            lines.append(f"{self.name}_sum {_format_value(self.sum)}")
+            lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+FETCH_PAGE_SECONDS = Histogram('olx_bot_fetch_page_seconds', 'Time to fetch one page of OLX offers.')
+SAVE_SECONDS = Histogram('olx_bot_save_listings_seconds', 'Time spent in save_listings_to_db.')
+MATCH_SECONDS = Histogram('olx_bot_match_seconds', 'Time to route one page of listings to users.')
+BACKFILL_SECONDS = Histogram('olx_bot_backfill_seconds', 'Time to select and queue the listings /search sends.')
+DEDUP_SECONDS = Histogram('olx_bot_dedup_seconds', 'Time spent looking up already-sent listings.')
+SEND_SECONDS = Histogram('olx_bot_send_listing_seconds', 'Time spent in send_listing.')
+TICK_SECONDS = Histogram('olx_bot_tick_seconds', 'Duration of one polling tick.', buckets=DEFAULT_BUCKETS + (30, 60))
+DELIVERY_LAG_SECONDS = Histogram('olx_bot_delivery_lag_seconds',
+                                 "Time from a listing's pushup_time to its delivery.", buckets=LAG_BUCKETS)
+LISTINGS_FETCHED = Counter('olx_bot_listings_fetched_total', 'Listings newer than the watermark.')
+MESSAGES_SENT = Counter('olx_bot_messages_sent_total', 'Listing messages sent.')
+DEDUP_FILTER_SKIPS = Counter('olx_bot_dedup_filter_skips_total',
+                             'Sent-listing checks answered by the in-memory filter without a query.')
+FETCH_ERRORS = Counter('olx_bot_fetch_errors_total', 'Failed OLX polls.')
+TICK_OVERLAPS = Counter('olx_bot_tick_overlaps_total', 'Ticks started while another tick was still running.')
+TICKS_IN_PROGRESS = Gauge('olx_bot_ticks_in_progress', 'Polling ticks currently running.')
+QUEUE_DEPTH = Gauge('olx_bot_delivery_queue_depth', 'Messages waiting in the delivery queue.')
+ACTIVE_USERS = Gauge('olx_bot_active_users', 'Users with an active search.')
+POLL_INTERVAL = Gauge('olx_bot_poll_interval_seconds', 'Delay before the next OLX poll.')
+DB_SIZE_BYTES = Gauge('olx_bot_db_size_bytes', 'Size of the SQLite database file at the last retention run.')
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+            pass  # Skip headers
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(port, host='0.0.0.0'):
+    """
+    Serve the registry in Prometheus text format at http://host:port/metrics.
+    """
+    server = await asyncio.start_server(_handle, host, port)
+    logger.info(f"Serving metrics on {host}:{port}/metrics")
+    return server
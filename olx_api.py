@@ -1,20 +1,91 @@
 # olx_api.py
 
-import requests
+import asyncio
+import httpx
 import datetime
 from dateutil.parser import parse as parse_date
+from unidecode import unidecode
 import logging
+import metrics
+from feeds import DEFAULT_FEED, get_feed
+from parsing import add_numeric_fields
 
 logger = logging.getLogger(__name__)
 
-def fetch_listings(filters, time_filter=None):
-    url = "https://www.olx.pl/api/v1/offers/"
+OLX_API_URL = "https://www.olx.pl/api/v1/offers/"
+OLX_DISTRICTS_URL = "https://www.olx.pl/api/v1/cities/{city_id}/districts/"
+PAGE_LIMIT = 50
+MAX_PAGES = 5  # Fetch up to 5 pages
+
+KRAKOW_DISTRICTS = {
+    'debniki': '261',
+    'biezanow-prokocim': '281',
+    'bienczyce': '285',
+    'bronowice': '253',
+    'czyzyny': '283',
+    'grzegorzki': '279',
+    'krowodrza': '255',
+    'lagiewniki-borek falecki': '259',
+    'mistrzejowice': '289',
+    'nowa huta': '287',
+    'podgorze': '263',
+    'podgorze duchackie': '277',
+    'pradnik bialy': '275',
+    'pradnik czerwony': '267',
+    'stare miasto': '273',
+    'swoszowice': '269',
+    'wzgorza krzeslawickie': '291',
+    'zwierzyniec': '257'
+}
+
+_http_client = None
+
+
+class FetchError(Exception):
+    """
+    Raised when an OLX page request fails. Carries the HTTP status and any
+    Retry-After hint so the poller can back off.
+    """
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def rate_limited(self):
+        return self.status == 429
+
+
+def get_http_client():
+    """
+    Return the shared keep-alive client, creating it on first use.
+    """
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            headers={"User-Agent": "Mozilla/5.0"},
+            timeout=10,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=60)
+        )
+    return _http_client
+
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def build_params(filters):
+    feed = get_feed(filters.get('feed_id'))
     params = {
         "offset": 0,
-        "limit": 50,
-        "category_id": 15,
-        "region_id": 4,
-        "city_id": 8959,
+        "limit": PAGE_LIMIT,
+        "category_id": feed['category_id'],
+        "region_id": feed['region_id'],
+        "city_id": feed['city_id'],
         "sort_by": "created_at:desc"
     }
 
@@ -25,117 +96,172 @@ def fetch_listings(filters, time_filter=None):
         params['filter_float_price:to'] = filters['max_price']
     if filters.get('district_ids'):
         params['district_id'] = filters['district_ids']
+    return params
+
+
+def query_key(filters):
+    """
+    Stable identifier of the OLX query a set of filters produces, used to key its watermark.
+    """
+    params = build_params(filters)
+    del params['offset'], params['limit']
+    return '&'.join(f"{key}={params[key]}" for key in sorted(params))
+
+
+@metrics.FETCH_PAGE_SECONDS.timed
+async def fetch_page(client, params, page):
+    page_params = dict(params, offset=page * params['limit'])
+    try:
+        response = await client.get(OLX_API_URL, params=page_params)
+        response.raise_for_status()
+        return response.json().get('data', [])
+    except httpx.HTTPStatusError as e:
+        retry_after = e.response.headers.get('Retry-After')
+        retry_after = int(retry_after) if retry_after and retry_after.isdigit() else None
+        raise FetchError(str(e), status=e.response.status_code, retry_after=retry_after) from e
+    except (httpx.HTTPError, ValueError) as e:
+        raise FetchError(str(e)) from e
+
+
+def parse_pushup_time(value):
+    # OLX sends ISO 8601 timestamps, so the stdlib parser handles almost all of them
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return parse_date(value)
+
 
-    headers = {
-        "User-Agent": "Mozilla/5.0"
+def parse_listing(item):
+    """
+    Turn a raw OLX offer into a listing dict, or None if it has no usable pushup_time.
+    """
+    pushup_time_str = item.get('pushup_time')
+    if not pushup_time_str:
+        return None
+
+    try:
+        listing_time = parse_pushup_time(pushup_time_str)
+    except Exception as e:
+        logger.error(f"Error parsing pushup_time: {e}")
+        return None
+
+    listing = {
+        'id': str(item.get('id')),
+        'title': item.get('title'),
+        'url': item.get('url'),
+        'price': None,
+        'rent_additional': None,
+        'location': None,
+        'region_id': None,
+        'region_name': None,
+        'region_normalized_name': None,
+        'district_id': None,
+        'district_name': None,
+        'area': None,
+        'rooms': None,
+        'is_business': item.get('business', False),
+        'description': item.get('description', '')
     }
 
-    parsed_listings = []
-    last_listing_time = None
-
-    max_pages = 5  # Fetch up to 5 pages
-    for page in range(max_pages):
-        params['offset'] = page * params['limit']
-        try:
-            response = requests.get(url, params=params, headers=headers, timeout=10)
-            response.raise_for_status()
-        except requests.RequestException as e:
-            logger.error(f"Error fetching listings: {e}")
-            break
-
-        data = response.json()
-        listings = data.get('data', [])
-        if not listings:
-            break  # No more listings
-
-        for item in listings:
-            pushup_time_str = item.get('pushup_time')
-
-            # Check if pushup_time exists and is after time_filter
-            if pushup_time_str:
-                try:
-                    listing_time = parse_date(pushup_time_str)
-                except Exception as e:
-                    logger.error(f"Error parsing pushup_time: {e}")
+    rooms_key = None
+    for param in item.get('params', []):
+        if param.get('key') == 'price':
+            listing['price'] = param.get('value', {}).get('label', 'N/A')
+        if param.get('key') == 'rent':
+            listing['rent_additional'] = param.get('value', {}).get('label', 'N/A')
+        if param.get('key') == 'm':
+            listing['area'] = param.get('value', {}).get('label', 'N/A')
+        if param.get('key') == 'rooms':
+            listing['rooms'] = param.get('value', {}).get('label', 'N/A')
+            rooms_key = param.get('value', {}).get('key')
+    add_numeric_fields(listing, rooms_key)
+
+    region_data = item.get('location', {}).get('region', {})
+    if region_data:
+        listing['region_id'] = region_data.get('id', 'N/A')
+        listing['region_name'] = region_data.get('name', 'N/A')
+        listing['region_normalized_name'] = region_data.get('normalized_name', 'N/A')
+
+    district_data = item.get('location', {}).get('district', {})
+    if district_data:
+        listing['district_id'] = str(district_data.get('id', 'N/A'))
+        listing['district_name'] = district_data.get('name', 'N/A')
+
+    listing['listing_time'] = listing_time
+    listing['listing_ts'] = int(listing_time.timestamp())
+    return listing
+
+
+async def iter_listing_pages(filters, time_filter=None, max_pages=MAX_PAGES):
+    """
+    Yield (listings, has_more) for the listings newer than time_filter, one
+    page at a time. has_more is False on the final page of a complete stream.
+    A failed page request raises FetchError.
+
+    Results are sorted newest first, so paging stops after the first page that
+    reaches the watermark. The next page is requested while the caller is
+    still processing the current one.
+    """
+    client = get_http_client()
+    params = build_params(filters)
+    feed_id = filters.get('feed_id') or DEFAULT_FEED
+    next_page = asyncio.ensure_future(fetch_page(client, params, 0))
+
+    try:
+        for page in range(max_pages):
+            try:
+                items = await next_page
+            finally:
+                next_page = None
+
+            if not items:
+                # No more listings. Earlier pages were yielded with has_more, so close the stream
+                if page > 0:
+                    yield [], False
+                return
+
+            parsed_listings = []
+            reached_watermark = False
+            for item in items:
+                listing = parse_listing(item)
+                if listing is None:
+                    continue
+                listing['feed_id'] = feed_id
+                # Skip listings older than the time_filter
+                if time_filter and listing['listing_time'] <= time_filter:
+                    reached_watermark = True
                     continue
-            else:
-                continue
-
-            # Check if the listing is after the provided time filter
-            if time_filter and listing_time <= time_filter:
-                continue  # Skip listings older than the time_filter
-
-            # Now proceed with parsing the listing data
-            listing = {
-                'id': str(item.get('id')),
-                'title': item.get('title'),
-                'url': item.get('url'),
-                'price': None,
-                'rent_additional': None,
-                'location': None,
-                'region_id': None,
-                'region_name': None,
-                'region_normalized_name': None,
-                'district_id': None,
-                'district_name': None,
-                'area': None,
-                'rooms': None,
-                'is_business': item.get('business', False),
-                'description': item.get('description', '')
-            }
-
-            for param in item.get('params', []):
-                if param.get('key') == 'price':
-                    listing['price'] = param.get('value', {}).get('label', 'N/A')
-                if param.get('key') == 'rent':
-                    listing['rent_additional'] = param.get('value', {}).get('label', 'N/A')
-                if param.get('key') == 'm':
-                    listing['area'] = param.get('value', {}).get('label', 'N/A')
-                if param.get('key') == 'rooms':
-                    listing['rooms'] = param.get('value', {}).get('label', 'N/A')
-
-            region_data = item.get('location', {}).get('region', {})
-            if region_data:
-                listing['region_id'] = region_data.get('id', 'N/A')
-                listing['region_name'] = region_data.get('name', 'N/A')
-                listing['region_normalized_name'] = region_data.get('normalized_name', 'N/A')
-
-            district_data = item.get('location', {}).get('district', {})
-            if district_data:
-                listing['district_id'] = str(district_data.get('id', 'N/A'))
-                listing['district_name'] = district_data.get('name', 'N/A')
-
-            listing['listing_time'] = listing_time
-            parsed_listings.append(listing)
-
-            # Track the most recent listing time
-            if not last_listing_time or listing_time > last_listing_time:
-                last_listing_time = listing_time
-
-    logger.info(f"Fetched {len(parsed_listings)} valid listings from OLX")
-    return parsed_listings, last_listing_time
-
-
-def fetch_districts():
+                parsed_listings.append(listing)
+
+            if not reached_watermark and len(items) >= params['limit'] and page + 1 < max_pages:
+                next_page = asyncio.ensure_future(fetch_page(client, params, page + 1))
+
+            yield parsed_listings, next_page is not None
+
+            if next_page is None:
+                return
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+
+async def fetch_districts(feed_id=DEFAULT_FEED):
+    """
+    Return {normalized district name: district id} for a feed's city, or an
+    empty dict if OLX has none. Kraków falls back to a built-in map.
+    """
+    feed = get_feed(feed_id)
+    fallback = dict(KRAKOW_DISTRICTS) if feed['city_id'] == 8959 else {}
+    try:
+        response = await get_http_client().get(OLX_DISTRICTS_URL.format(city_id=feed['city_id']))
+        response.raise_for_status()
+        districts = response.json().get('data', [])
+    except (httpx.HTTPError, ValueError) as e:
+        logger.error(f"Error fetching districts for feed {feed_id}: {e}")
+        return fallback
+
     district_name_to_id = {
-        'debniki': '261',
-        'biezanow-prokocim': '281',
-        'bienczyce': '285',
-        'bronowice': '253',
-        'czyzyny': '283',
-        'grzegorzki': '279',
-        'krowodrza': '255',
-        'lagiewniki-borek falecki': '259',
-        'mistrzejowice': '289',
-        'nowa huta': '287',
-        'podgorze': '263',
-        'podgorze duchackie': '277',
-        'pradnik bialy': '275',
-        'pradnik czerwony': '267',
-        'stare miasto': '273',
-        'swoszowice': '269',
-        'wzgorza krzeslawickie': '291',
-        'zwierzyniec': '257'
+        unidecode(district['name']).lower(): str(district['id'])
+        for district in districts if district.get('id') and district.get('name')
     }
-
-    return district_name_to_id
+    return district_name_to_id or fallback
@@ -0,0 +1,50 @@
+# parsing.py
+#
+# Numeric values from OLX's display labels. Shared by the API client, which
+# parses at ingest, and the database, which backfills older rows.
+
+import re
+
+ROOMS_BY_KEY = {'one': 1, 'two': 2, 'three': 3, 'four': 4}
+NUMBER_RE = re.compile(r'\d[\d\s]*(?:[.,]\d+)?')
+
+
+def parse_number(label):
+    """
+    Pull the number out of an OLX label such as '2 500 zł' or '45,5 m²'.
+    """
+    if not label:
+        return None
+    match = NUMBER_RE.search(str(label))
+    if not match:
+        return None
+    return float(re.sub(r'\s', '', match.group()).replace(',', '.'))
+
+
+def parse_price(price_str):
+    value = parse_number(price_str)
+    return int(value) if value is not None else None
+
+
+def parse_rooms(label, key=None):
+    if key in ROOMS_BY_KEY:
+        return ROOMS_BY_KEY[key]
+    if label and 'kawalerka' in label.lower():
+        return 1
+    value = parse_number(label)
+    return int(value) if value is not None else None
+
+
+def add_numeric_fields(listing, rooms_key=None):
+    """
+    Parse the price, rent, area and rooms labels once, at ingest time.
+    """
+    listing['price_value'] = parse_price(listing.get('price'))
+    listing['rent_value'] = parse_price(listing.get('rent_additional'))
+    if listing['price_value'] is not None:
+        listing['total_price'] = listing['price_value'] + (listing['rent_value'] or 0)
+    else:
+        listing['total_price'] = None
+    listing['area_value'] = parse_number(listing.get('area'))
+    listing['rooms_value'] = parse_rooms(listing.get('rooms'), rooms_key)
+    return listing
@@ -0,0 +1,97 @@
+# planner.py
+
+import logging
+from feeds import DEFAULT_FEED
+
+logger = logging.getLogger(__name__)
+
+MAX_QUERIES = 8  # OLX queries per feed and poll, including the city-wide one
+
+
+def _price_bounds(filters):
+    """
+    The OLX price range that can contain listings matching the filters.
+
+    OLX filters on the advertised price only. With use_total_price the user
+    compares price + czynsz, which is never below the price, so only the
+    upper bound can be pushed down.
+    """
+    max_price = filters.get('max_price')
+    if filters.get('use_total_price'):
+        return None, max_price
+    return filters.get('min_price'), max_price
+
+
+def _union(bounds):
+    """
+    Smallest single range covering all the (min, max) bounds; None means unbounded.
+    """
+    mins = [low for low, _ in bounds]
+    maxes = [high for _, high in bounds]
+    low = None if None in mins else min(mins)
+    high = None if None in maxes else max(maxes)
+    return low, high
+
+
+def _query(feed_id, low, high, district_id=None):
+    filters = {'feed_id': feed_id}
+    if low is not None:
+        filters['min_price'] = low
+    if high is not None:
+        filters['max_price'] = high
+    if district_id is not None:
+        filters['district_ids'] = district_id
+    return filters
+
+
+def plan_queries(user_filters, max_queries=MAX_QUERIES):
+    """
+    Merge the active users' filters into a small set of OLX queries, planned
+    separately for every feed that has users. The default feed is always
+    polled, so /search has listings to show even before anyone subscribes.
+    """
+    by_feed = {DEFAULT_FEED: {}}
+    for user_id, filters in user_filters.items():
+        by_feed.setdefault(filters.get('feed_id') or DEFAULT_FEED, {})[user_id] = filters
+
+    queries = []
+    for feed_id, feed_filters in by_feed.items():
+        queries.extend(plan_feed_queries(feed_id, feed_filters, max_queries))
+    return queries
+
+
+def plan_feed_queries(feed_id, user_filters, max_queries=MAX_QUERIES):
+    """
+    Merge one feed's users' filters into a small set of OLX queries.
+
+    Each district that users watch gets its own query, bounded by the union of
+    those users' price ranges, so quiet districts are not pushed off the first
+    pages by busy ones. One city-wide query always runs: it covers users who
+    watch every district and keeps listings flowing into the database for
+    /search. When there are more districts than the query budget allows, the
+    ones with the fewest users fall back to the city-wide query.
+    """
+    city_bounds = []
+    district_bounds = {}
+    for filters in user_filters.values():
+        bounds = _price_bounds(filters)
+        if filters.get('districts'):
+            for district_id in filters['districts']:
+                district_bounds.setdefault(district_id, []).append(bounds)
+        else:
+            city_bounds.append(bounds)
+
+    # Busiest districts first; ties broken by id so the plan is stable between polls
+    districts = sorted(district_bounds, key=lambda d: (-len(district_bounds[d]), d))
+    kept, dropped = districts[:max_queries - 1], districts[max_queries - 1:]
+    for district_id in dropped:
+        city_bounds.extend(district_bounds[district_id])
+
+    queries = [_query(feed_id, *_union(city_bounds)) if city_bounds else _query(feed_id, None, None)]
+    for district_id in kept:
+        queries.append(_query(feed_id, *_union(district_bounds[district_id]), district_id=district_id))
+
+    if dropped:
+        logger.info(f"{len(dropped)} districts of feed {feed_id} exceed the query budget and are covered by "
+                    f"the city-wide query")
+    return queries
@@ -0,0 +1,148 @@
+# render.py
+
+import html
+import logging
+import re
+from collections import OrderedDict
+from telegram.helpers import escape_markdown
+
+logger = logging.getLogger(__name__)
+
+RENDER_CACHE_SIZE = 2000
+DESCRIPTION_LENGTH = 200
+
+# Markup that never contributes visible text, split the way html.parser
+# splits it. CDATA keeps its content, and script/style bodies are dropped along
+# with their tags, up to the end of the text if never closed. A '</>' is
+# dropped without ending the text around it. Markup that is never closed is
+# matched as unclosed: html.parser keeps it as raw text up to the next '>' (or
+# '<'), joined to the text around it, and parses on from there.
+MARKUP_RE = re.compile(
+    r'<!--.*?--\s*>'
+    r'|<!\[CDATA\[(?P<cdata>.*?)\]\]>'
+    r'|<(?P<raw>script|style)\b(?:"[^"]*"|\'[^\']*\'|[^\'">])*(?<!/)>.*?(?:</\s*(?P=raw)\s*>|\Z)'
+    r'|<[a-zA-Z](?:"[^"]*"|\'[^\']*\'|[^\'">])*>'
+    r'|(?P<empty_end></>)'
+    r'|</[^>]*>'
+    r'|<!(?!--|\[CDATA\[)[^>]*>|<\?[^>]*>'
+    r'|(?P<unclosed><[a-zA-Z/!?][^>]*>|<[a-zA-Z/!?][^<]*(?=<)|<(?=[a-zA-Z/!?]))',
+    re.DOTALL | re.IGNORECASE
+)
+
+ASCII_SPACE_RE = re.compile(r'[ \n\t\f\r]*')
+
+_render_cache = OrderedDict()
+
+
+def escape_text(text):
+    """
+    Escape text for Telegram's Markdown V1 to prevent formatting issues.
+    """
+    if text is None:
+        return ''
+    return escape_markdown(str(text), version=1)
+
+
+def _collapse_space(node):
+    # BeautifulSoup turns a whitespace-only string into one newline or space
+    if not ASCII_SPACE_RE.fullmatch(node):
+        return node
+    return '\n' if '\n' in node else ' '
+
+
+def iter_text_nodes(text):
+    """
+    Yield the visible text between tags, with entities decoded.
+    """
+    pos = 0
+    node = ''
+    for match in MARKUP_RE.finditer(text):
+        node += html.unescape(text[pos:match.start()])
+        pos = match.end()
+        if match.group('unclosed'):
+            # Text, but not decoded, and joined to the text around it
+            node += match.group('unclosed')
+            continue
+        if match.group('empty_end'):
+            continue
+        if node:
+            yield _collapse_space(node)
+            node = ''
+        if match.group('cdata') is not None:
+            yield _collapse_space(match.group('cdata'))
+    node += html.unescape(text[pos:])
+    if node:
+        yield _collapse_space(node)
+
+
+def replace_html_tags(text, limit=None):
+    """
+    Strip tags from an OLX description, joining text nodes with a space like
+    BeautifulSoup's get_text(separator=' '). With a limit, scanning stops once
+    more than limit characters have been collected.
+    """
+    parts = []
+    length = 0
+    for node in iter_text_nodes(text):
+        if parts:
+            length += 1
+        parts.append(node)
+        length += len(node)
+        if limit is not None and length > limit:
+            break
+    return ' '.join(parts)
+
+
+def format_listing(listing):
+    # Escaping never shortens text, so DESCRIPTION_LENGTH + 1 source characters
+    # are enough to decide whether the escaped description needs truncating
+    description = escape_text(replace_html_tags(listing.get('description') or '', limit=DESCRIPTION_LENGTH))
+
+    if len(description) > DESCRIPTION_LENGTH:
+        description = description[:DESCRIPTION_LENGTH] + '...'
+
+    rent_additional = escape_text(listing.get('rent_additional', 'No czynsz') or 'No czynsz')
+    district = escape_text(listing.get('district_name', 'District not provided') or 'District not provided')
+    area = escape_text(listing.get('area', 'N/A') or 'N/A')
+    rooms = escape_text(listing.get('rooms', 'N/A') or 'N/A')
+    is_owner = 'Yes' if not listing['is_business'] else 'No'
+    is_owner = escape_text(is_owner)
+
+    # Escape constants that contain special characters
+    title_const = "*Title:*"
+    price_const = "*Price:*"
+    district_const = "*District:*"
+    area_const = "*Area:*"
+    rooms_const = "*Rooms:*"
+    czynsz_const = "*Czynsz (additional):*"
+    from_owner_const = "From owner:"
+    view_listing_const = "View Listing"
+
+    message = (
+        f"{title_const} {escape_text(listing['title'])}\n"
+        f"💰 {price_const} {escape_text(listing['price'])} - {district_const} {district}\n"
+        f"🧭 {area_const} {area}, {rooms_const} {rooms}\n"
+        f"🐙 {czynsz_const} {rent_additional}\n"
+        f"📝 {description}\n"
+        f"🥸 {from_owner_const} {is_owner}\n"
+        f"🔗 [{escape_text(view_listing_const)}]({escape_text(listing['url'])})"
+    )
+    return message
+
+
+def render_listing(listing):
+    """
+    Return the Markdown message for a listing, rendering it at most once while
+    it stays in the bounded LRU cache.
+    """
+    listing_id = listing.get('id')
+    message = _render_cache.get(listing_id)
+    if message is not None:
+        _render_cache.move_to_end(listing_id)
+        return message
+
+    message = format_listing(listing)
+    _render_cache[listing_id] = message
+    if len(_render_cache) > RENDER_CACHE_SIZE:
+        _render_cache.popitem(last=False)
+    return message
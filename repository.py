@@ -0,0 +1,182 @@
+# repository.py
+#
+# Async access to db.py for the bot. Writes are queued to a single writer
+# thread that commits them in groups, reads run on a small reader pool, and
+# long maintenance jobs on their own thread, so SQLite never blocks the event
+# loop and write throughput is not bound by one fsync per write.
+
+import asyncio
+import functools
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import db
+
+logger = logging.getLogger(__name__)
+
+GROUP_COMMIT_MAX_OPS = int(os.getenv('GROUP_COMMIT_MAX_OPS', '64'))
+GROUP_COMMIT_DELAY = float(os.getenv('GROUP_COMMIT_DELAY', '0.002'))  # seconds to wait for more writes
+
+
+class GroupCommitWriter:
+    """
+    Single writer thread that coalesces queued writes into one transaction.
+
+    A group is committed once GROUP_COMMIT_MAX_OPS writes are queued or
+    GROUP_COMMIT_DELAY has passed since the first one. A write's future is
+    resolved only after its group commits, and write connections run with
+    synchronous=FULL, so an awaited write is on disk.
+    """
+
+    def __init__(self, max_ops=GROUP_COMMIT_MAX_OPS, delay=GROUP_COMMIT_DELAY):
+        self.max_ops = max_ops
+        self.delay = delay
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) and return a concurrent.futures.Future for its result.
+        """
+        future = Future()
+        self.queue.put((future, func, args, kwargs))
+        return future
+
+    def _collect(self, first):
+        group = [first]
+        deadline = time.monotonic() + self.delay
+        while len(group) < self.max_ops:
+            try:
+                item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                # Stop after this group
+                self.queue.put(None)
+                break
+            group.append(item)
+        return group
+
+    def _run(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                break
+            group = self._collect(first)
+            try:
+                results = db.run_batch([(func, args, kwargs) for _, func, args, kwargs in group])
+            except sqlite3.Error as e:
+                # Nothing was stored. Run each write in its own transaction, so it
+                # handles a failure the way its callers expect
+                logger.error(f"Database error when committing {len(group)} writes, retrying them one by one: {e}")
+                results = [self._run_alone(func, args, kwargs) for _, func, args, kwargs in group]
+            for (future, *_), (result, error) in zip(group, results):
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    @staticmethod
+    def _run_alone(func, args, kwargs):
+        try:
+            return func(*args, **kwargs), None
+        except Exception as e:
+            return None, e
+
+    def close(self):
+        """
+        Commit everything queued so far and stop the thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+_writer = GroupCommitWriter()
+_readers = ThreadPoolExecutor(max_workers=db.READER_POOL_SIZE, thread_name_prefix='db-reader')
+_maintenance = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-maintenance')
+
+
+def _run_on(executor, func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+    return wrapper
+
+
+def _write_op(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await asyncio.wrap_future(_writer.submit(func, *args, **kwargs))
+    return wrapper
+
+
+# Writes; awaiting one returns once its group has committed
+set_user_filters = _write_op(db.set_user_filters)
+reset_user_filters = _write_op(db.reset_user_filters)
+set_user_active = _write_op(db.set_user_active)
+set_user_feed = _write_op(db.set_user_feed)
+add_user_district = _write_op(db.add_user_district)
+remove_user_district = _write_op(db.remove_user_district)
+save_listings_to_db = _write_op(db.save_listings_to_db)
+mark_listings_as_sent = _write_op(db.mark_listings_as_sent)
+save_districts = _write_op(db.save_districts)
+set_worker_cursor = _write_op(db.set_worker_cursor)
+acquire_lease = _write_op(db.acquire_lease)
+release_lease = _write_op(db.release_lease)
+
+# Reads
+get_sent_listing_ids_for_users = _run_on(_readers, db.get_sent_listing_ids_for_users)
+get_watermark = _run_on(_readers, db.get_watermark)
+get_latest_listing_time = _run_on(_readers, db.get_latest_listing_time)
+get_districts = _run_on(_readers, db.get_districts)
+get_logged_listings = _run_on(_readers, db.get_logged_listings)
+get_worker_cursor = _run_on(_readers, db.get_worker_cursor)
+get_log_id_before = _run_on(_readers, db.get_log_id_before)
+get_latest_user_change = _run_on(_readers, db.get_latest_user_change)
+reload_changed_users = _run_on(_readers, db.reload_changed_users)
+
+
+async def get_backfill_listings(user_id, filters, **kwargs):
+    """
+    db.iter_backfill_listings as a list, drained on a reader thread. Its limit caps the size.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_readers, lambda: list(db.iter_backfill_listings(user_id, filters, **kwargs)))
+
+
+# Maintenance
+run_retention = _run_on(_maintenance, db.run_retention)
+
+
+# Served from db's in-memory user cache, so they never wait on SQLite
+get_user_filters = db.get_user_filters
+get_active_user_filters = db.get_active_user_filters
+get_active_users = db.get_active_users
+
+
+def add_user_listener(callback):
+    """
+    Register callback(user_id) for user changes. Changes are applied on the
+    database threads, so the callback is scheduled on the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    db.add_user_listener(lambda user_id: loop.call_soon_threadsafe(callback, user_id))
+
+
+async def close():
+    """
+    Let queued work finish, then stop the writer, close the executors and
+    every connection.
+    """
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, _maintenance.shutdown)
+    await loop.run_in_executor(None, _writer.close)
+    await loop.run_in_executor(None, _readers.shutdown)
+    db.close_db()
@@ -0,0 +1,74 @@
+# scheduler.py
+
+import datetime
+import logging
+import random
+
+logger = logging.getLogger(__name__)
+
+MIN_INTERVAL = 5  # Seconds between polls while listings keep arriving
+BASE_INTERVAL = 10
+DAY_MAX_INTERVAL = 30
+NIGHT_MAX_INTERVAL = 120
+QUIET_HOURS_UTC = (23, 5)  # Roughly midnight to 6-7am in Kraków
+MAX_BACKOFF = 600
+JITTER = 0.1
+
+
+class AdaptivePoller:
+    """
+    Picks the delay before the next OLX poll.
+
+    The interval halves while new listings are arriving and grows by half
+    again on every empty poll, up to a ceiling that is higher during quiet
+    hours. Errors back off exponentially with full jitter, and a 429 never
+    retries sooner than the server asked.
+    """
+
+    def __init__(self, min_interval=MIN_INTERVAL, base_interval=BASE_INTERVAL, day_max=DAY_MAX_INTERVAL,
+                 night_max=NIGHT_MAX_INTERVAL, max_backoff=MAX_BACKOFF):
+        self.min_interval = min_interval
+        self.base_interval = base_interval
+        self.day_max = day_max
+        self.night_max = night_max
+        self.max_backoff = max_backoff
+        self.interval = base_interval
+        self.errors = 0
+        self.next_delay = base_interval
+
+    def is_quiet_hour(self, now=None):
+        hour = (now or datetime.datetime.now(datetime.timezone.utc)).hour
+        start, end = QUIET_HOURS_UTC
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def max_interval(self, now=None):
+        return self.night_max if self.is_quiet_hour(now) else self.day_max
+
+    def record_success(self, new_count, now=None):
+        """
+        Update the interval after a successful poll and return the next delay.
+        """
+        self.errors = 0
+        if new_count:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval(now), self.interval * 1.5)
+        self.next_delay = self.interval * random.uniform(1 - JITTER, 1 + JITTER)
+        return self.next_delay
+
+    def record_error(self, rate_limited=False, retry_after=None):
+        """
+        Back off after a failed poll and return the next delay.
+        """
+        self.errors += 1
+        backoff = min(self.max_backoff, self.base_interval * 2 ** self.errors)
+        if rate_limited:
+            # Rate limiting means we were polling too fast even when things recover
+            self.interval = min(self.max_interval(), self.interval * 2)
+        self.next_delay = random.uniform(backoff / 2, backoff)
+        if retry_after:
+            self.next_delay = max(self.next_delay, retry_after)
+        logger.warning(f"Poll failed ({self.errors} in a row), retrying in {self.next_delay:.0f}s")
+        return self.next_delay
@@ -0,0 +1,120 @@
+# subscriptions.py
+
+import bisect
+import logging
+from feeds import DEFAULT_FEED
+
+logger = logging.getLogger(__name__)
+
+NO_MIN = float('-inf')
+NO_MAX = float('inf')
+
+
+class PriceBucket:
+    """
+    Users kept sorted by their lower price bound, so a lookup only scans the
+    users whose min_price the listing already clears.
+    """
+
+    def __init__(self):
+        self.keys = []  # (min_price, user_id), sorted
+        self.max_prices = []
+
+    def add(self, user_id, min_price, max_price):
+        pos = bisect.bisect_left(self.keys, (min_price, user_id))
+        self.keys.insert(pos, (min_price, user_id))
+        self.max_prices.insert(pos, max_price)
+
+    def remove(self, user_id, min_price):
+        pos = bisect.bisect_left(self.keys, (min_price, user_id))
+        if pos < len(self.keys) and self.keys[pos] == (min_price, user_id):
+            del self.keys[pos]
+            del self.max_prices[pos]
+
+    def match(self, price, matched):
+        end = bisect.bisect_right(self.keys, (price, NO_MAX))
+        for i in range(end):
+            if price <= self.max_prices[i]:
+                matched.add(self.keys[i][1])
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class SubscriptionIndex:
+    """
+    Inverted index from listing attributes to the active users they match.
+
+    Users are partitioned by their feed and (from_owner, use_total_price)
+    flags, then bucketed by district, with None holding users who watch every
+    district. A listing is only checked against the partitions of its own
+    feed, and within them against its district's bucket and the catch-all.
+    """
+
+    def __init__(self):
+        self.partitions = {}  # feed_id -> {(from_owner, use_total_price) -> {district_id or None: PriceBucket}}
+        self.users = {}  # user_id -> (feed_id, partition key, district keys, min_price)
+
+    def load(self, user_filters):
+        for user_id, filters in user_filters.items():
+            self.update_user(user_id, filters)
+        logger.info(f"Subscription index built for {len(self.users)} users")
+
+    def update_user(self, user_id, filters):
+        self.remove_user(user_id)
+        if filters is None:
+            return
+
+        feed_id = filters.get('feed_id') or DEFAULT_FEED
+        key = (bool(filters.get('from_owner')), bool(filters.get('use_total_price')))
+        districts = tuple(dict.fromkeys(filters.get('districts') or ())) or (None,)
+        min_price = filters.get('min_price')
+        max_price = filters.get('max_price')
+        min_price = NO_MIN if min_price is None else min_price
+        max_price = NO_MAX if max_price is None else max_price
+
+        buckets = self.partitions.setdefault(feed_id, {}).setdefault(key, {})
+        for district_id in districts:
+            buckets.setdefault(district_id, PriceBucket()).add(user_id, min_price, max_price)
+        self.users[user_id] = (feed_id, key, districts, min_price)
+
+    def remove_user(self, user_id):
+        entry = self.users.pop(user_id, None)
+        if entry is None:
+            return
+        feed_id, key, districts, min_price = entry
+        partitions = self.partitions[feed_id]
+        buckets = partitions[key]
+        for district_id in districts:
+            bucket = buckets[district_id]
+            bucket.remove(user_id, min_price)
+            if not bucket:
+                del buckets[district_id]
+        if not buckets:
+            del partitions[key]
+        if not partitions:
+            del self.partitions[feed_id]
+
+    def match(self, listing):
+        """
+        Return the set of user_ids whose filters accept the listing.
+        """
+        matched = set()
+
+        partitions = self.partitions.get(listing.get('feed_id') or DEFAULT_FEED, {})
+        for (from_owner, use_total_price), buckets in partitions.items():
+            if from_owner and listing['is_business']:
+                continue
+
+            value = listing.get('total_price') if use_total_price else listing.get('price_value')
+            if value is None:
+                continue
+
+            for district_id in (listing.get('district_id'), None):
+                bucket = buckets.get(district_id)
+                if bucket is not None:
+                    bucket.match(value, matched)
+        return matched
+
+    def __len__(self):
+        return len(self.users)
@@ -0,0 +1,122 @@
+# webhook.py
+#
+# Minimal HTTP server that receives Telegram updates by webhook and hands
+# them to the application's handlers. It sits behind a TLS-terminating
+# reverse proxy, since Telegram only calls https URLs.
+
+import asyncio
+import hmac
+import json
+import logging
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY_BYTES = 1 << 20  # Updates are a few KB; anything bigger is not from Telegram
+READ_TIMEOUT = 10
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+
+async def _read_request(reader):
+    request_line = await asyncio.wait_for(reader.readline(), timeout=READ_TIMEOUT)
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout=READ_TIMEOUT)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    parts = request_line.decode('latin-1').split()
+    method, path = (parts[0], parts[1].split('?')[0]) if len(parts) >= 2 else ('', '')
+    return method, path, headers
+
+
+class UserOrderedProcessor:
+    """
+    Processes updates concurrently across users, at most limit at once, but
+    one at a time and in arrival order for each user. ConversationHandler and
+    the filter toggles read and then write a user's state, so a user's
+    updates must not overlap.
+    """
+
+    def __init__(self, application, limit):
+        self.application = application
+        self.semaphore = asyncio.BoundedSemaphore(limit)
+        self.tails = {}  # user id -> task processing that user's newest update
+
+    def submit(self, update):
+        # Updates without a user share one sequence
+        key = update.effective_user.id if update.effective_user else None
+        task = asyncio.create_task(self._process(update, self.tails.get(key)))
+        self.tails[key] = task
+        task.add_done_callback(lambda done: self._forget(key, done))
+
+    async def _process(self, update, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with self.semaphore:
+            try:
+                await self.application.process_update(update)
+            except Exception as e:
+                logger.error(f"Error processing update {update.update_id}: {e}")
+
+    def _forget(self, key, task):
+        if self.tails.get(key) is task:
+            del self.tails[key]
+
+    async def join(self):
+        """
+        Wait for every submitted update to be processed.
+        """
+        while self.tails:
+            await asyncio.gather(*self.tails.values(), return_exceptions=True)
+
+
+def _respond(writer, status, body=b''):
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+        f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+    )
+
+
+async def start_server(processor, port, path, secret_token, host='0.0.0.0'):
+    """
+    Accept POSTed updates at http://host:port/path and submit them to a
+    UserOrderedProcessor. Requests without the secret token Telegram was
+    given in setWebhook are refused.
+    """
+    expected = secret_token.encode()
+
+    async def handle(reader, writer):
+        try:
+            method, request_path, headers = await _read_request(reader)
+            length = int(headers.get('content-length') or 0)
+            if request_path != path:
+                _respond(writer, '404 Not Found', b'Not found\n')
+            elif method != 'POST':
+                _respond(writer, '405 Method Not Allowed', b'Method not allowed\n')
+            elif not hmac.compare_digest(headers.get(SECRET_HEADER, '').encode(), expected):
+                _respond(writer, '403 Forbidden', b'Forbidden\n')
+            elif not 0 < length <= MAX_BODY_BYTES:
+                _respond(writer, '413 Payload Too Large', b'Bad request size\n')
+            else:
+                body = await asyncio.wait_for(reader.readexactly(length), timeout=READ_TIMEOUT)
+                try:
+                    update = Update.de_json(json.loads(body), processor.application.bot)
+                except (ValueError, TypeError, KeyError) as e:
+                    logger.warning(f"Rejected a malformed webhook update: {e}")
+                    _respond(writer, '400 Bad Request', b'Bad request\n')
+                else:
+                    # Handlers run in the background, so Telegram gets its answer right away
+                    processor.submit(update)
+                    _respond(writer, '200 OK')
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logger.info(f"Serving the Telegram webhook on {host}:{port}{path}")
+    return server
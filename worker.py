@@ -0,0 +1,160 @@
+# worker.py
+#
+# Delivery side of the bot when it runs as several processes. One fetcher
+# polls OLX and stores new listings, which appends them to listing_log. Each
+# delivery worker owns the users whose user_id falls in its shard, follows
+# listing_log from its own cursor, and matches and sends with its own
+# subscription index and dispatcher.
+
+import asyncio
+import logging
+
+import db
+import metrics
+import repository
+from delivery import DeliveryDispatcher, GLOBAL_RATE, BACKFILL_RATE
+from subscriptions import SubscriptionIndex
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1  # Seconds between listing_log reads once a worker has caught up
+# Queued deliveries live in memory, so on startup the listings logged this
+# long ago are routed again; the sent-listings check skips the delivered ones
+REPLAY_WINDOW = 3600
+
+
+def parse_shard(value):
+    """
+    Parse an "index/count" shard such as "0/4".
+    """
+    index, count = (int(part) for part in value.split('/'))
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard {value}")
+    return index, count
+
+
+async def replay_recent_listings(subscription_index, dispatcher, window=REPLAY_WINDOW):
+    """
+    Route the listings logged in the last window seconds again, to recover
+    deliveries that were queued but not sent when the process stopped.
+    """
+    log_id = await repository.get_log_id_before(window)
+    if log_id is None:
+        return
+    count = 0
+    while True:
+        log_id, listings = await repository.get_logged_listings(log_id)
+        if not listings:
+            break
+        await route_listings(subscription_index, dispatcher, listings)
+        count += len(listings)
+    logger.info(f"Re-routed {count} recent listings, {dispatcher.queue_depth()} deliveries queued")
+
+
+async def route_listings(subscription_index, dispatcher, listings):
+    """
+    Queue new listings for every user whose filters match them and who has not received them yet.
+    """
+    matches = {}
+    with metrics.MATCH_SECONDS.time():
+        for listing in listings:
+            for user_id in subscription_index.match(listing):
+                matches.setdefault(user_id, []).append(listing)
+    if not matches:
+        return
+
+    # One lookup for the whole batch, and only for pairs the in-memory filter cannot rule out
+    sent_by_user = await repository.get_sent_listing_ids_for_users(
+        {user_id: [listing['id'] for listing in user_listings] for user_id, user_listings in matches.items()}
+    )
+
+    for user_id, user_listings in matches.items():
+        already_sent = sent_by_user.get(user_id, set())
+        for listing in user_listings:
+            if listing['id'] not in already_sent:
+                dispatcher.submit(user_id, listing)
+
+
+class ShardWorker:
+    """
+    Delivers new listings to the users of one shard.
+
+    Users are kept up to date from user_changes, since their commands are
+    handled by the fetcher process. The cursor is saved after each batch is
+    queued; a restart resumes REPLAY_WINDOW before it, so deliveries still
+    queued when the worker stopped are routed again.
+    """
+
+    def __init__(self, shard_index, shard_count, send, poll_interval=POLL_INTERVAL):
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.name = f'shard-{shard_index}-of-{shard_count}'
+        self.poll_interval = poll_interval
+        self.subscription_index = SubscriptionIndex()
+        # Workers share the bot's Telegram rate limit with each other and the fetcher's /search
+        self.dispatcher = DeliveryDispatcher(send, repository.mark_listings_as_sent,
+                                             global_rate=(GLOBAL_RATE - BACKFILL_RATE) / shard_count)
+        self.cursor = None
+        self.user_change = None
+
+    def owns(self, user_id):
+        return user_id % self.shard_count == self.shard_index
+
+    def refresh_user(self, user_id):
+        if not self.owns(user_id):
+            return
+        filters = db.get_user_filters(user_id)
+        if filters is None or not filters['is_active']:
+            self.subscription_index.remove_user(user_id)
+        else:
+            self.subscription_index.update_user(user_id, filters)
+
+    async def start(self):
+        # The fetcher's /search backfills also send to these users, so the filter would miss them
+        db.disable_sent_filter()
+        # Take the change position before loading, so no change is missed in between
+        self.user_change = await repository.get_latest_user_change()
+        db.load_user_cache()
+        user_filters = repository.get_active_user_filters()
+        self.subscription_index.load({user_id: filters for user_id, filters in user_filters.items()
+                                      if self.owns(user_id)})
+        repository.add_user_listener(self.refresh_user)
+
+        self.cursor = await repository.get_worker_cursor(self.name)
+        replay_from = await repository.get_log_id_before(REPLAY_WINDOW)
+        if self.cursor is None or replay_from is None:
+            raise RuntimeError(f"Could not read the cursor of {self.name}")
+        self.cursor = min(self.cursor, replay_from)
+        self.dispatcher.start()
+        metrics.QUEUE_DEPTH.set_function(self.dispatcher.queue_depth)
+        metrics.ACTIVE_USERS.set_function(lambda: len(self.subscription_index))
+        logger.info(f"Worker {self.name} started at listing_log id {self.cursor}")
+
+    async def poll_once(self):
+        """
+        Apply user changes, then route the next batch of logged listings. Returns the number read.
+        """
+        # Listener callbacks are queued on the loop before this await returns
+        self.user_change = await repository.reload_changed_users(self.user_change)
+
+        cursor, listings = await repository.get_logged_listings(self.cursor)
+        if listings:
+            await route_listings(self.subscription_index, self.dispatcher, listings)
+        if cursor != self.cursor:
+            await repository.set_worker_cursor(self.name, cursor)
+            self.cursor = cursor
+        return len(listings)
+
+    async def run(self):
+        await self.start()
+        try:
+            while True:
+                try:
+                    count = await self.poll_once()
+                except Exception as e:
+                    logger.error(f"Error in worker {self.name}: {e}")
+                    count = 0
+                if count < db.LOG_BATCH_SIZE:
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            await self.dispatcher.stop()